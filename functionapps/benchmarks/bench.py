@@ -0,0 +1,298 @@
+"""Offline benchmarks of the scheduler, worker and dkng hot paths against local stand-ins (see standins.py).
+
+Each (scenario, catalogue size) runs in a fresh python process so cold import time and peak memory are its own,
+and so the apps' same named sibling modules (resources, models, function_app) never share one interpreter.
+
+    python functionapps/benchmarks/bench.py --sizes 10 100 1000 10000 --output bench.json
+    python functionapps/benchmarks/bench.py --baseline bench.json   # exits 1 on a regression beyond --tolerance
+
+Reported per run: throughput (units/sec, units being jobs queued, messages sent or handled, or rows written),
+p50/p99 latency of one invocation, peak RSS and the time to import the app's function_app.
+"""
+
+# other imports
+import os
+import sys
+import json
+import time
+import uuid
+import resource
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, UTC
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONAPPS_DIR = os.path.dirname(BENCH_DIR)
+SHARED_DIR = os.path.join(FUNCTIONAPPS_DIR, 'shared')
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+# events per sgp_scrape message, as queued by the dkng timers for one start time
+SGP_EVENTS_PER_MESSAGE = 10
+
+
+def _percentile(sorted_values:list, q:float):
+    # nearest rank percentile
+    return sorted_values[max(0, min(len(sorted_values)-1, round(q*len(sorted_values))-1))]
+
+
+def _timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def _job_rows(Job, size:int, function_name:str, cron_schedule:str) -> list[dict]:
+    # let the database generate integer ids, string ids are uuids like instance ids
+    rows = [dict(name=f'bench_job_{i}', function_name=function_name, cron_schedule=cron_schedule, status='active') for i in range(size)]
+    if Job.__table__.c.id.type.python_type is not int:
+        for row in rows:
+            row['id'] = uuid.uuid4().hex
+    return rows
+
+
+def _seed_jobs(engine, size:int, function_name:str='bench_noop', cron_schedule:str='*/5 * * * *') -> list:
+    from tcgds.jobs import Job
+    from sqlalchemy import insert, select
+    with engine.begin() as psql_connection:
+        psql_connection.execute(insert(Job), _job_rows(Job, size, function_name, cron_schedule))
+        return psql_connection.execute(select(Job.id, Job.name).order_by(Job.name)).all()
+
+
+def _count(engine, table) -> int:
+    from sqlalchemy import select, func
+    with engine.connect() as psql_connection:
+        return psql_connection.execute(select(func.count()).select_from(table)).scalar_one()
+
+
+# scenarios: (app, size, repeat) -> (units, per invocation latencies in seconds)
+
+def bench_queue_jobs(app, size:int, repeat:int):
+    from azure.functions.timer import TimerRequest
+    from tcgds.jobs import Instance
+    engine = app.get_psql_engine()
+    _seed_jobs(engine, size)
+    app.sync_schedules(TimerRequest(past_due=False))
+    # every job fires each 5 minutes so each run queues the whole catalogue once
+    latencies = [_timed(app.queue_jobs, TimerRequest(past_due=False)) for _ in range(repeat)]
+    return _count(engine, Instance.__table__), latencies
+
+
+def bench_dispatch_pending(app, size:int, repeat:int):
+    from azure.functions.timer import TimerRequest
+    from standins import memory_queues, BENCH_QUEUE_CONN_STR
+    from pending_dispatch import schedule_dispatch
+    engine = app.get_psql_engine()
+    latencies = []
+    for _ in range(repeat):
+        with engine.begin() as psql_connection:
+            schedule_dispatch(psql_connection, [dict(message=f'bench message {i}', dispatch_at=datetime.now(tz=UTC)) for i in range(size)])
+        latencies.append(_timed(app.dispatch_pending, TimerRequest(past_due=False)))
+    return (size*repeat if BENCH_QUEUE_CONN_STR else memory_queues.count()), latencies
+
+
+def bench_http_run_jobs(app, size:int, repeat:int):
+    import azure.functions as func
+    jobs = _seed_jobs(app.get_psql_engine(), size)
+    latencies = []
+    for _ in range(repeat):
+        for _, job_name in jobs:
+            request = func.HttpRequest('GET', f'/api/job/run/{job_name}', route_params={'jobname':job_name}, body=b'')
+            start = time.perf_counter()
+            response = app.http_run_jobs(request)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code!=200:
+                raise RuntimeError(f'http_run_jobs returned {response.status_code} for {job_name}: {response.get_body()!r}')
+    return len(latencies), latencies
+
+
+def bench_job_orchestrator(app, size:int, repeat:int):
+    import azure.functions as func
+    from tcgds.jobs import Instance
+    from sqlalchemy import insert
+    engine = app.get_psql_engine()
+    app.JOB_HANDLERS['bench_noop'] = 'standins:noop_job'
+    jobs = _seed_jobs(engine, size)
+    # the first pass misses the job definition cache, later passes hit it; each pass runs new instances, the worker
+    # drops messages of instances that already completed
+    latencies = []
+    for _ in range(repeat):
+        instances = [(uuid.uuid4().hex, job_id) for job_id, _ in jobs]
+        with engine.begin() as psql_connection:
+            psql_connection.execute(insert(Instance), [dict(id=instance_id, job_id=job_id, status='queued', start_time=datetime.now(tz=UTC)) for instance_id, job_id in instances])
+        for instance_id, job_id in instances:
+            message = func.QueueMessage(body=json.dumps({'instance_id':instance_id, 'job_id':job_id, 'overrides':{}}))
+            latencies.append(_timed(app.job_orchestrator, message))
+    return len(latencies), latencies
+
+
+def bench_sgp_scrape(app, size:int, repeat:int):
+    import azure.functions as func
+    import pandas as pd
+    from standins import SGP_COLUMNS
+    engine = app.get_psql_engine()
+    # copy_frame needs the target table, shaped like the scraper frame plus the load time
+    pd.DataFrame(columns=SGP_COLUMNS + ['added']).astype({'added':'datetime64[ns, UTC]'}).to_sql('event_sgps', engine, index=False, if_exists='replace')
+    event_ids = list(range(size))
+    messages = [event_ids[i:i+SGP_EVENTS_PER_MESSAGE] for i in range(0, size, SGP_EVENTS_PER_MESSAGE)]
+    latencies = []
+    for _ in range(repeat):
+        for message_event_ids in messages:
+            message = func.QueueMessage(body=json.dumps({'func':'fanduel', 'event_ids':message_event_ids}))
+            latencies.append(_timed(app.sgp_scrape, message))
+    from sqlalchemy import table
+    return _count(engine, table('event_sgps')), latencies
+
+
+# scenario -> (app folder, benchmark, units reported, needs postgres)
+SCENARIOS = {
+    'queue_jobs': ('linux-python-job-scheduler', bench_queue_jobs, 'jobs queued', False),
+    'dispatch_pending': ('linux-python-job-scheduler', bench_dispatch_pending, 'messages sent', False),
+    'http_run_jobs': ('linux-python-job-scheduler', bench_http_run_jobs, 'jobs queued', False),
+    'job_orchestrator': ('linux-python-worker', bench_job_orchestrator, 'messages handled', False),
+    'sgp_scrape': ('linux-python-dkng', bench_sgp_scrape, 'rows written', True), # COPY
+}
+
+
+def run_scenario(scenario:str, size:int, repeat:int) -> dict:
+    """Run one scenario in this process; called in the child process started by `main`."""
+    import standins
+    import importlib
+    app_folder, bench_fn, units_name, needs_postgres = SCENARIOS[scenario]
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    os.chdir(work_dir)
+    sys.path[:0] = [os.path.join(FUNCTIONAPPS_DIR, app_folder), SHARED_DIR]
+    os.environ.setdefault('FANDUEL_MAX_PER_SECOND', '1000') # measure our fetch path, not the production request budget
+
+    standins.install_secret_standin()
+    start = time.perf_counter()
+    app = importlib.import_module('function_app')
+    import_seconds = time.perf_counter() - start
+
+    url = standins.bench_psql_url(work_dir)
+    if needs_postgres and not standins.is_postgres(url):
+        return dict(scenario=scenario, size=size, skipped='needs BENCH_PSQL_URL (writes with COPY)')
+
+    from sqlalchemy import create_engine
+    from tcgds.jobs import Job, JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME
+    from instrumentation import metadata as instrumentation_metadata
+    metadatas = [Job.metadata]
+    if os.path.exists(os.path.join(FUNCTIONAPPS_DIR, app_folder, 'pending_dispatch.py')):
+        metadatas.append(importlib.import_module('pending_dispatch').metadata)
+    if app_folder=='linux-python-dkng':
+        # dkng opens one database per sportsbook, point them all at the bench database
+        bench_engine = create_engine(url)
+        app.get_psql_engine = lambda database=None: bench_engine
+    else:
+        # the app's own get_psql_engine (pool settings, table creation) runs against the bench database
+        import app_resources
+        app_resources.psql_connection_string = url
+        metadatas.append(importlib.import_module('models').Base.metadata)
+    standins.reset_schema(url, metadatas + [instrumentation_metadata])
+    standins.install_queue_standin([JOBS_QUEUE_CONN_STR_NAME, 'SA_CONNECTION_STRING'])
+    standins.ensure_queues([JOBS_QUEUE_NAME, 'prod2queue'])
+    if hasattr(app, 'fanduel_get_event_sgps'):
+        app.fanduel_get_event_sgps = standins.fanduel_event_sgps_fixture
+
+    start = time.perf_counter()
+    units, latencies = bench_fn(app, size, repeat)
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latencies)
+    return dict(
+        scenario=scenario,
+        size=size,
+        backend='postgres' if standins.is_postgres(url) else 'sqlite',
+        units=units,
+        units_name=units_name,
+        elapsed_seconds=elapsed,
+        throughput=units/max(elapsed, 1e-9),
+        p50_ms=_percentile(latencies, 0.5)*1000,
+        p99_ms=_percentile(latencies, 0.99)*1000,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+        import_seconds=import_seconds,
+    )
+
+
+def _run_child(scenario:str, size:int, repeat:int, timeout:int) -> dict:
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', scenario, str(size), '--repeat', str(repeat)]
+    try:
+        completed = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout, cwd=BENCH_DIR)
+    except subprocess.TimeoutExpired:
+        return dict(scenario=scenario, size=size, error=f'timed out after {timeout}s')
+    if completed.returncode!=0:
+        return dict(scenario=scenario, size=size, error=completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f'exit {completed.returncode}')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+RESULTS_HEADER = f"{'scenario':<18}{'size':>7}  {'backend':<9}{'units':>8}{'units/sec':>12}{'p50 ms':>10}{'p99 ms':>10}{'rss MB':>9}{'import s':>10}"
+
+
+def _format_result(result:dict) -> str:
+    prefix = f"{result['scenario']:<18}{result['size']:>7}  "
+    if 'skipped' in result:
+        return prefix + 'skipped: ' + result['skipped']
+    if 'error' in result:
+        return prefix + 'error: ' + result['error']
+    return prefix + (f"{result['backend']:<9}{result['units']:>8}{result['throughput']:>12,.1f}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+                     f"{result['peak_rss_mb']:>9.1f}{result['import_seconds']:>10.3f}")
+
+
+def compare_to_baseline(results:list[dict], baseline:list[dict], tolerance:float) -> list[str]:
+    """Regressions against a previous --output: lower throughput, or higher p99 latency or import time, by more than `tolerance`."""
+    baseline_by_key = {(result['scenario'], result['size']):result for result in baseline if 'throughput' in result}
+    regressions = []
+    for result in results:
+        base = baseline_by_key.get((result['scenario'], result['size']))
+        if base is None or 'throughput' not in result:
+            continue
+        key = f"{result['scenario']} size={result['size']}"
+        if result['throughput']<base['throughput']*(1 - tolerance):
+            regressions.append(f"{key}: throughput {result['throughput']:,.1f}/s vs {base['throughput']:,.1f}/s")
+        for metric in ('p99_ms', 'import_seconds'):
+            if result[metric]>base[metric]*(1 + tolerance):
+                regressions.append(f'{key}: {metric} {result[metric]:.3f} vs {base[metric]:.3f}')
+    return regressions
+
+
+def main(argv:list[str]=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='job catalogue (or event) counts')
+    parser.add_argument('--repeat', type=int, default=3, help='invocations per size for timer scenarios, passes over the catalogue for the others')
+    parser.add_argument('--timeout', type=int, default=1800, help='seconds before a single run is abandoned')
+    parser.add_argument('--output', help='write the results as json, usable as a later --baseline')
+    parser.add_argument('--baseline', help='results json of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--child', nargs=2, metavar=('SCENARIO', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        scenario, size = args.child
+        print(json.dumps(run_scenario(scenario, int(size), args.repeat)))
+        return 0
+
+    results = []
+    print(RESULTS_HEADER)
+    print('-'*len(RESULTS_HEADER))
+    for scenario in args.scenarios:
+        for size in args.sizes:
+            results.append(_run_child(scenario, size, args.repeat, args.timeout))
+            print(_format_result(results[-1]), flush=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = [result for result in results if 'error' in result]
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print('\nRegressions beyond {:.0%}:'.format(args.tolerance))
+            print('\n'.join(regressions))
+            return 1
+    return 1 if failed else 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
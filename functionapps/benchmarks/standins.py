@@ -0,0 +1,208 @@
+# local stand-ins for the cloud services the function apps talk to, installed in the benchmark process only
+#
+# secrets: a fake SecretClient, the apps read it at import (dkng) or on first engine use (scheduler, worker)
+# queues: an in-memory QueueClient, or Azurite when BENCH_QUEUE_CONN_STR is set
+# postgres: BENCH_PSQL_URL (a database dedicated to benchmarks) or a fresh sqlite file per run
+# scrapers: recorded responses from BENCH_FIXTURES_DIR, otherwise synthetic frames of the same shape
+
+# other imports
+import os
+import json
+import time
+import random
+import threading
+from functools import cache
+from types import SimpleNamespace
+from collections import defaultdict
+from datetime import UTC
+
+
+BENCH_QUEUE_CONN_STR = os.environ.get('BENCH_QUEUE_CONN_STR')
+BENCH_PSQL_URL = os.environ.get('BENCH_PSQL_URL')
+BENCH_FIXTURES_DIR = os.environ.get('BENCH_FIXTURES_DIR')
+# simulated round trip of one scraper request and the rows it returns
+BENCH_HTTP_LATENCY = float(os.environ.get('BENCH_HTTP_LATENCY', 0.01))
+BENCH_SGP_ROWS = int(os.environ.get('BENCH_SGP_ROWS', 200))
+
+MEMORY_QUEUE_CONN_STR = 'UseMemoryQueue=true'
+
+
+class FakeSecretClient:
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_secret(self, name:str):
+        return SimpleNamespace(name=name, value='bench')
+
+
+class MemoryQueues:
+    """Messages sent per queue name, shared by every sync and async client in the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = defaultdict(list)
+
+    def append(self, queue_name:str, content:str, visibility_timeout:int|None) -> dict:
+        with self.lock:
+            self.messages[queue_name].append((content, visibility_timeout))
+        return {'id':f'{queue_name}-{len(self.messages[queue_name])}'}
+
+    def count(self, queue_name:str=None) -> int:
+        if queue_name is not None:
+            return len(self.messages[queue_name])
+        return sum(len(messages) for messages in self.messages.values())
+
+
+memory_queues = MemoryQueues()
+
+
+class MemoryQueueClient:
+
+    def __init__(self, queue_name:str):
+        self.queue_name = queue_name
+
+    def send_message(self, content:str, visibility_timeout:int=None, **kwargs) -> dict:
+        return memory_queues.append(self.queue_name, content, visibility_timeout)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class AsyncMemoryQueueClient(MemoryQueueClient):
+
+    async def send_message(self, content:str, visibility_timeout:int=None, **kwargs) -> dict:
+        return memory_queues.append(self.queue_name, content, visibility_timeout)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+def install_secret_standin() -> None:
+    # must run before the app is imported, apps bind SecretClient at import
+    import azure.keyvault.secrets
+    azure.keyvault.secrets.SecretClient = FakeSecretClient
+
+
+def install_queue_standin(conn_str_names:list[str]) -> None:
+    """Point every queue connection string setting at Azurite, or route clients to the in-memory queues."""
+    for conn_str_name in conn_str_names:
+        os.environ[conn_str_name] = BENCH_QUEUE_CONN_STR or MEMORY_QUEUE_CONN_STR
+    if BENCH_QUEUE_CONN_STR:
+        return
+    from azure.storage.queue import QueueClient
+    from azure.storage.queue.aio import QueueClient as AsyncQueueClient
+    QueueClient.from_connection_string = classmethod(lambda cls, conn_str, queue_name, **kwargs: MemoryQueueClient(queue_name))
+    AsyncQueueClient.from_connection_string = classmethod(lambda cls, conn_str, queue_name, **kwargs: AsyncMemoryQueueClient(queue_name))
+
+
+def ensure_queues(queue_names:list[str]) -> None:
+    # Azurite starts empty; the in-memory queues need no setup
+    if not BENCH_QUEUE_CONN_STR:
+        return
+    from azure.storage.queue import QueueClient
+    from azure.core.exceptions import ResourceExistsError
+    for queue_name in queue_names:
+        try:
+            QueueClient.from_connection_string(BENCH_QUEUE_CONN_STR, queue_name).create_queue()
+        except ResourceExistsError:
+            pass
+
+
+def _install_sqlite_types() -> None:
+    # postgres types used by the app tables, mapped to what sqlite can store
+    from sqlalchemy import BigInteger
+    from sqlalchemy.ext.compiler import compiles
+    from sqlalchemy.dialects.postgresql import JSONB
+    from sqlalchemy.dialects.sqlite.base import DATETIME
+
+    compiles(BigInteger, 'sqlite')(lambda type_, compiler, **kw: 'INTEGER') # identity columns need INTEGER PRIMARY KEY
+    compiles(JSONB, 'sqlite')(lambda type_, compiler, **kw: 'JSON')
+
+    # sqlite drops the timezone; every time the apps store is utc, so read them back as utc
+    result_processor = DATETIME.result_processor
+    def utc_result_processor(self, dialect, coltype):
+        process = result_processor(self, dialect, coltype)
+        def to_utc(value):
+            value = process(value) if process is not None else value
+            return value.replace(tzinfo=UTC) if value is not None and value.tzinfo is None else value
+        return to_utc
+    DATETIME.result_processor = utc_result_processor
+
+
+def bench_psql_url(work_dir:str) -> str:
+    if BENCH_PSQL_URL:
+        from sqlalchemy import make_url
+        # every run drops and recreates the app tables, never point this at a shared database
+        if 'bench' not in (make_url(BENCH_PSQL_URL).database or ''):
+            raise RuntimeError(f'BENCH_PSQL_URL must name a database dedicated to benchmarks (containing "bench"), got: {BENCH_PSQL_URL}')
+        return BENCH_PSQL_URL
+    _install_sqlite_types()
+    return f"sqlite:///{os.path.join(work_dir, 'bench.sqlite')}"
+
+
+def is_postgres(url:str) -> bool:
+    return url.startswith('postgresql')
+
+
+def reset_schema(url:str, metadatas:list) -> None:
+    """Drop and create the tables of `metadatas` so each run starts from the same empty schema."""
+    from sqlalchemy import create_engine
+    engine = create_engine(url)
+    for metadata in reversed(metadatas):
+        metadata.drop_all(engine)
+    for metadata in metadatas:
+        metadata.create_all(engine)
+    engine.dispose()
+
+
+SGP_COLUMNS = ['type', 'betting_opportunity_id', 'total_bets', 'event_id', 'competition_id', 'selections', 'american_odds', 'decimal_odds', 'parlay_legs']
+
+
+def _synthetic_event_sgps(event_id) -> list[dict]:
+    rng = random.Random(str(event_id))
+    records = []
+    for i in range(BENCH_SGP_ROWS):
+        legs = rng.randint(2, 4)
+        decimal_odds = round(rng.uniform(2.5, 40.0), 2)
+        american_odds = round((decimal_odds - 1)*100)
+        records.append(dict(type='sgp', betting_opportunity_id=f'{event_id}-{i}', total_bets=rng.randint(1, 5000), event_id=event_id, competition_id=rng.randint(1, 50),
+                            selections=[f'{event_id}-sel-{rng.randint(0, 999)}' for _ in range(legs)], american_odds=american_odds, decimal_odds=decimal_odds, parlay_legs=legs))
+    return records
+
+
+@cache
+def _recorded_event_sgps() -> list[dict]|None:
+    if BENCH_FIXTURES_DIR is None:
+        return None
+    path = os.path.join(BENCH_FIXTURES_DIR, 'fanduel_event_sgps.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def fanduel_event_sgps_fixture(event_id):
+    """Stands in for tcgds fanduel get_event_sgps: waits BENCH_HTTP_LATENCY, then returns the recorded (or synthetic) sgps of one event."""
+    import pandas as pd
+    time.sleep(BENCH_HTTP_LATENCY)
+    recorded = _recorded_event_sgps()
+    records = [dict(record, event_id=event_id) for record in recorded] if recorded is not None else _synthetic_event_sgps(event_id)
+    return pd.DataFrame(records, columns=SGP_COLUMNS)
+
+
+def noop_job(json_message:dict) -> None:
+    # job handler registered by the job_orchestrator benchmark, isolates the dispatch overhead
+    pass
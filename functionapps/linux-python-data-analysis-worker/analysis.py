@@ -0,0 +1,256 @@
+# streaming odds analysis of the sportsbook snapshot tables
+#
+# tables are read through a server side cursor ordered by the aggregate's key, so every key group arrives
+# contiguously and is aggregated once, chunk by chunk, without holding the table in memory; a (key, snapshot) index on
+# each table serves that order. Runs are incremental: each reads the snapshots added after the aggregate's watermark,
+# the latest snapshot the previous runs merged, and merges them into the running per key rows.
+
+# local imports
+from resources import get_psql_engine
+from models import LineMovement, AnalysisWatermark
+from bulkload import copy_frame
+from instrumentation import span
+
+# other imports
+import os
+import logging
+import numpy as np
+import pandas as pd
+from typing import Iterator
+from functools import cache
+from datetime import datetime
+from sqlalchemy import Connection, Engine, MetaData, Table, Column, Index, select, delete, table, column, inspect
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.schema import CreateIndex
+
+
+# rows fetched from the server side cursor at a time, and result rows buffered before a bulk write
+ANALYSIS_CHUNK_SIZE = int(os.environ.get('ANALYSIS_CHUNK_SIZE', 100_000))
+ANALYSIS_WRITE_BATCH = int(os.environ.get('ANALYSIS_WRITE_BATCH', 50_000))
+
+# snapshot tables per book database, a job message can override them with `sources`
+ANALYSIS_SOURCES = {
+    'fanduel': ['event_sgps'],
+    'dkng': ['event_pre_fab_bets', 'event_sgps'],
+}
+SNAPSHOT_COL = 'added' # load time stamped on every scraped row
+LINE_KEY_COLS = ['betting_opportunity_id']
+ODDS_COLS = ['decimal_odds', 'american_odds']
+
+
+def implied_probability(decimal_odds=None, american_odds=None) -> np.ndarray:
+    """Implied probability per price, from decimal odds where usable and american odds otherwise; NaN if neither is."""
+    probability = None
+    if decimal_odds is not None:
+        decimal_odds = pd.to_numeric(decimal_odds, errors='coerce').to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            probability = np.where(decimal_odds>1, 1/decimal_odds, np.nan)
+    if american_odds is not None:
+        american_odds = pd.to_numeric(american_odds, errors='coerce').to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            from_american = np.where(american_odds>=100, 100/(american_odds + 100), np.where(american_odds<=-100, -american_odds/(100 - american_odds), np.nan))
+        probability = from_american if probability is None else np.where(np.isnan(probability), from_american, probability)
+    if probability is None:
+        raise ValueError(f'Implied probability needs one of {ODDS_COLS}')
+    return probability
+
+
+def stream_frames(psql_connection:Connection, query, chunk_size:int=ANALYSIS_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    # yield_per streams through a server side cursor, at most chunk_size rows are buffered client side
+    result = psql_connection.execute(query, execution_options={'yield_per':chunk_size})
+    columns = list(result.keys())
+    for rows in result.partitions():
+        yield pd.DataFrame(rows, columns=columns)
+
+
+def complete_groups(frames:Iterator[pd.DataFrame], key_cols:list[str]) -> Iterator[pd.DataFrame]:
+    """Re-chunk frames sorted by `key_cols` so that no key group is split across two yielded frames."""
+    carry = None
+    for frame in frames:
+        if carry is not None:
+            frame = pd.concat([carry, frame], ignore_index=True)
+        if frame.empty:
+            continue
+        # the last group may continue in the next chunk, hold it back
+        last_start = _group_starts(frame, key_cols)[-1]
+        carry = frame.iloc[last_start:].reset_index(drop=True)
+        if last_start>0:
+            yield frame.iloc[:last_start].reset_index(drop=True)
+    if carry is not None and not carry.empty:
+        yield carry
+
+
+def _group_starts(frame:pd.DataFrame, key_cols:list[str]) -> np.ndarray:
+    # frame is sorted by key_cols, a group starts wherever any key differs from the row before
+    changed = np.zeros(max(len(frame) - 1, 0), dtype=bool)
+    for col in key_cols:
+        values = frame[col].to_numpy()
+        changed |= values[1:]!=values[:-1]
+    return np.concatenate([[0], np.flatnonzero(changed) + 1])
+
+
+def line_movement(frame:pd.DataFrame) -> pd.DataFrame:
+    """Opening, closing and range of implied probability per betting opportunity, for a frame sorted by (id, snapshot)."""
+    starts = _group_starts(frame, LINE_KEY_COLS)
+    ends = np.append(starts[1:], len(frame)) - 1
+    probability = frame['implied_probability'].to_numpy()
+    snapshots = frame[SNAPSHOT_COL].to_numpy()
+    return pd.DataFrame({
+        'betting_opportunity_id': frame['betting_opportunity_id'].to_numpy()[starts].astype(str),
+        'first_added': snapshots[starts],
+        'last_added': snapshots[ends],
+        'snapshots': ends - starts + 1,
+        'opening_probability': probability[starts],
+        'closing_probability': probability[ends],
+        'min_probability': np.minimum.reduceat(probability, starts),
+        'max_probability': np.maximum.reduceat(probability, starts),
+        'movement': probability[ends] - probability[starts],
+    })
+
+
+@cache
+def ensure_scan_index(psql_engine:Engine, table_name:str, key_cols:tuple[str]) -> None:
+    # (key, snapshot) index serving the aggregate's ordered scan, built concurrently so scrapes keep writing to the
+    # table meanwhile, which postgres only allows outside a transaction
+    cols = key_cols + (SNAPSHOT_COL,)
+    source = Table(table_name, MetaData(), *(Column(col) for col in cols))
+    index = Index(f"ix_{table_name}_{'_'.join(cols)}", *source.c, postgresql_concurrently=True)
+    with psql_engine.connect().execution_options(isolation_level='AUTOCOMMIT') as psql_connection:
+        psql_connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+# merging the aggregate of a window of later snapshots into a key's running row: opening from the earliest snapshot,
+# closing from the latest
+_OPENING = 'CASE WHEN EXCLUDED.first_added<target.first_added THEN EXCLUDED.opening_probability ELSE target.opening_probability END'
+_CLOSING = 'CASE WHEN EXCLUDED.last_added>target.last_added THEN EXCLUDED.closing_probability ELSE target.closing_probability END'
+LINE_MOVEMENT_MERGE = {
+    'instance_id': 'EXCLUDED.instance_id',
+    'first_added': 'LEAST(target.first_added, EXCLUDED.first_added)',
+    'last_added': 'GREATEST(target.last_added, EXCLUDED.last_added)',
+    'snapshots': 'target.snapshots + EXCLUDED.snapshots',
+    'opening_probability': _OPENING,
+    'closing_probability': _CLOSING,
+    'min_probability': 'LEAST(target.min_probability, EXCLUDED.min_probability)',
+    'max_probability': 'GREATEST(target.max_probability, EXCLUDED.max_probability)',
+    'movement': f'({_CLOSING}) - ({_OPENING})',
+    'computed_at': 'EXCLUDED.computed_at',
+}
+# a window is merged only when it is later than everything already in the row, so a retried run that rereads a window
+# never counts its snapshots twice
+LINE_MOVEMENT_MERGE_WHERE = 'target.last_added<EXCLUDED.first_added'
+
+# (name, key columns, aggregate, model, merge, merge condition) of every aggregate of a snapshot table
+# no vig aggregate: the snapshot tables have no key for a market of mutually exclusive outcomes, summing the implied
+# probability of every parlay of an event's type is not one
+AGGREGATES = [
+    ('line_movement', LINE_KEY_COLS, line_movement, LineMovement, LINE_MOVEMENT_MERGE, LINE_MOVEMENT_MERGE_WHERE),
+]
+
+
+def get_watermark(psql_engine:Engine, table_name:str, aggregate:str) -> datetime|None:
+    """Latest snapshot of table_name merged into `aggregate`, None before its first run."""
+    query = select(AnalysisWatermark.last_added).where(AnalysisWatermark.source_table==table_name, AnalysisWatermark.aggregate==aggregate)
+    with psql_engine.connect() as psql_connection:
+        return psql_connection.execute(query).scalar()
+
+
+def set_watermark(psql_engine:Engine, table_name:str, aggregate:str, last_added:datetime, instance_id:str) -> None:
+    stmt = insert(AnalysisWatermark).values(source_table=table_name, aggregate=aggregate, last_added=last_added, instance_id=instance_id)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[AnalysisWatermark.source_table, AnalysisWatermark.aggregate],
+        set_=dict(last_added=stmt.excluded.last_added, instance_id=stmt.excluded.instance_id),
+    )
+    with psql_engine.begin() as psql_connection:
+        psql_connection.execute(stmt)
+
+
+def reset_aggregate(psql_engine:Engine, table_name:str, aggregate:str, model) -> None:
+    """Drop the running rows and watermark of table_name's `aggregate`, the next run rebuilds them from every snapshot."""
+    with psql_engine.begin() as psql_connection:
+        psql_connection.execute(delete(model).where(model.source_table==table_name))
+        psql_connection.execute(delete(AnalysisWatermark).where(AnalysisWatermark.source_table==table_name, AnalysisWatermark.aggregate==aggregate))
+
+
+def _write(psql_engine:Engine, frames:list[pd.DataFrame], model, merge:dict[str, str], merge_where:str) -> int:
+    if not frames:
+        return 0
+    conflict_cols = [col.name for col in model.__table__.primary_key.columns]
+    return copy_frame(psql_engine, pd.concat(frames, ignore_index=True), model.__tablename__, time_col='computed_at',
+                      conflict_cols=conflict_cols, update_set=merge, update_where=merge_where)
+
+
+def _run_aggregate(psql_engine:Engine, table_name:str, key_cols:list[str], odds_cols:list[str], aggregate, model, identity:dict,
+                   merge:dict[str, str], merge_where:str, since:datetime=None, chunk_size:int=ANALYSIS_CHUNK_SIZE) -> tuple[int, int, datetime|None]:
+    # one ordered scan of the snapshots of table_name added after `since`, results are merged ANALYSIS_WRITE_BATCH rows
+    # at a time; returns (rows read, rows merged, latest snapshot read)
+    source = table(table_name, *(column(col) for col in key_cols + [SNAPSHOT_COL] + odds_cols))
+    query = select(*source.c).order_by(*(source.c[col] for col in key_cols + [SNAPSHOT_COL]))
+    if since is not None:
+        query = query.where(source.c[SNAPSHOT_COL]>since)
+    rows_read = rows_written = 0
+    last_added = None
+    pending, pending_rows = [], 0
+    with psql_engine.connect() as psql_connection:
+        for frame in complete_groups(stream_frames(psql_connection, query, chunk_size), key_cols):
+            rows_read += len(frame)
+            frame_last_added = frame[SNAPSHOT_COL].max()
+            last_added = frame_last_added if last_added is None else max(last_added, frame_last_added)
+            frame = frame.assign(implied_probability=implied_probability(*(frame[col] if col in odds_cols else None for col in ODDS_COLS)))
+            frame = frame[~np.isnan(frame['implied_probability'].to_numpy())].reset_index(drop=True)
+            if frame.empty:
+                continue
+            result = aggregate(frame).assign(**identity)
+            pending.append(result)
+            pending_rows += len(result)
+            if pending_rows>=ANALYSIS_WRITE_BATCH:
+                rows_written += _write(psql_engine, pending, model, merge, merge_where)
+                pending, pending_rows = [], 0
+    rows_written += _write(psql_engine, pending, model, merge, merge_where)
+    return rows_read, rows_written, last_added
+
+
+def analyse_table(book:str, table_name:str, instance_id:str, rebuild:bool=False, chunk_size:int=ANALYSIS_CHUNK_SIZE) -> None:
+    """Merge the snapshots of one book's table added since the previous run into its aggregates, skipped when the table
+    lacks their columns; `rebuild` drops the aggregates first and recomputes them from every snapshot."""
+    psql_engine = get_psql_engine(book)
+    columns = {col['name'] for col in inspect(psql_engine).get_columns(table_name)}
+    odds_cols = [col for col in ODDS_COLS if col in columns]
+    if not odds_cols or SNAPSHOT_COL not in columns:
+        logging.warning(f'{book}.{table_name} has no {" or ".join(ODDS_COLS)} / {SNAPSHOT_COL} columns, skipping')
+        return
+    identity = dict(instance_id=instance_id, book=book, source_table=table_name)
+    for name, key_cols, aggregate, model, merge, merge_where in AGGREGATES:
+        if not set(key_cols)<=columns:
+            logging.warning(f'{book}.{table_name} has no {", ".join(key_cols)} columns, skipping {name}')
+            continue
+        with span(f'{book}.{table_name}/{name}') as aggregate_span:
+            if rebuild:
+                reset_aggregate(psql_engine, table_name, name, model)
+            with span('ensure_scan_index'):
+                ensure_scan_index(psql_engine, table_name, tuple(key_cols))
+            since = get_watermark(psql_engine, table_name, name)
+            rows_read, rows_written, last_added = _run_aggregate(psql_engine, table_name, key_cols, odds_cols, aggregate, model, identity,
+                                                                 merge, merge_where, since, chunk_size)
+            # advanced once the whole window is merged; a run failing before rereads the window, the merge condition
+            # skips the keys it already merged
+            if last_added is not None:
+                set_watermark(psql_engine, table_name, name, last_added, instance_id)
+            aggregate_span.add(rows=rows_read)
+        logging.info(f"{name} of {book}.{table_name}: {rows_read} snapshots added after {since or 'the first snapshot'} read, {rows_written} rows merged")
+
+
+def odds_analysis(json_message:dict) -> None:
+    """Analyse every source table of every book in the job message (`sources`, optional `rebuild` and `chunk_size`)."""
+    sources = json_message.get('sources') or ANALYSIS_SOURCES
+    rebuild = bool(json_message.get('rebuild'))
+    chunk_size = int(json_message.get('chunk_size') or ANALYSIS_CHUNK_SIZE)
+    failed = []
+    for book, table_names in sources.items():
+        for table_name in table_names:
+            try:
+                analyse_table(book, table_name, json_message['instance_id'], rebuild, chunk_size)
+            except Exception as exc:
+                logging.exception(f'Failed to analyse {book}.{table_name}')
+                failed.append((f'{book}.{table_name}', exc))
+    if failed:
+        raise RuntimeError(f'Failed to analyse {len(failed)} tables:\n' + '\n'.join(f'{name}: {exc!r}' for name, exc in failed))
@@ -1,15 +1,58 @@
-# azure imports 
+# azure imports
 import azure.functions as func
-import azure.durable_functions as df  
+import azure.durable_functions as df
 
 # tcgds imports
-from tcgds.jobs import JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME 
+from tcgds.reporting import EmailExceptionHandler
 from tcgds.customauth import CustomAuth
 from tcgds.postgres import psql_connection_string
 
+# local imports
+from job_definitions import resolve_job_message
+from resources import get_psql_engine
+from app_resources import instance_run
+from instrumentation import record_instance, span
+from job_queues import ANALYSIS_QUEUE_NAME, ANALYSIS_QUEUE_CONN_STR_NAME
+
+# other imports
+import os
+import importlib
+from functools import cache
+from contextlib import ExitStack
+
+
+# analysis handlers by function_name as 'module:attribute', each imported the first time it is dispatched; new ones are
+# also added to job_queues.ANALYSIS_FUNCTION_NAMES so the scheduler sends them to this app's queue
+ANALYSIS_HANDLERS = {
+    'odds_analysis': 'analysis:odds_analysis',
+}
+
+
+@cache
+def get_analysis_handler(function_name:str):
+    try:
+        handler_path = ANALYSIS_HANDLERS[function_name]
+    except KeyError:
+        raise ValueError(f'No analysis handler registered for function_name: {function_name}') from None
+    module_name, attr_name = handler_path.split(':')
+    return getattr(importlib.import_module(module_name), attr_name)
+
+
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
-@app.queue_trigger('message', JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME)
+@app.queue_trigger('message', ANALYSIS_QUEUE_NAME, ANALYSIS_QUEUE_CONN_STR_NAME)
 def analysis_job_orchestrator(message:func.QueueMessage):
-    
-    pass
\ No newline at end of file
+    with ExitStack() as stack:
+        exc_handler = stack.enter_context(EmailExceptionHandler())
+        exc_handler.subject = 'Analysis Job Orchestrator'
+
+        json_message = resolve_job_message(message.get_json())
+        function_name = json_message['function_name']
+        exc_handler.subject = json_message['job_name'] + ' ' + json_message['instance_id']
+
+        stack.enter_context(record_instance(json_message['instance_id'], function_name, get_psql_engine()))
+        with span('import_handler'):
+            handler = get_analysis_handler(function_name)
+        psql_connection = stack.enter_context(get_psql_engine().connect())
+        with instance_run(psql_connection, json_message['instance_id']):
+            handler(json_message)
@@ -0,0 +1,39 @@
+# analysis result tables, created in each book's database
+
+# other imports
+from datetime import datetime
+from sqlalchemy import DateTime
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class LineMovement(Base):
+    # running state per betting opportunity, each run merges the snapshots added since the previous one into it
+    __tablename__ = 'analysis_line_movement'
+
+    source_table: Mapped[str] = mapped_column(primary_key=True)
+    betting_opportunity_id: Mapped[str] = mapped_column(primary_key=True)
+    book: Mapped[str]
+    instance_id: Mapped[str] # last run that merged snapshots into the row
+    first_added: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    last_added: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    snapshots: Mapped[int]
+    opening_probability: Mapped[float]
+    closing_probability: Mapped[float]
+    min_probability: Mapped[float]
+    max_probability: Mapped[float]
+    movement: Mapped[float] # closing - opening implied probability
+    computed_at: Mapped[datetime|None] = mapped_column(DateTime(timezone=True))
+
+
+class AnalysisWatermark(Base):
+    # latest snapshot time an aggregate has merged per source table, the next run reads only later snapshots
+    __tablename__ = 'analysis_watermark'
+
+    source_table: Mapped[str] = mapped_column(primary_key=True)
+    aggregate: Mapped[str] = mapped_column(primary_key=True)
+    last_added: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    instance_id: Mapped[str]
@@ -0,0 +1,16 @@
+# process-wide resources shared by every function invocation on a worker
+
+# local imports
+from models import Base
+from app_resources import create_psql_engine
+
+# other
+from functools import cache
+from sqlalchemy import Engine
+
+
+@cache
+def get_psql_engine(database:str=None) -> Engine:
+    # one pooled engine per database per process, `database` selects a book's database (e.g. fanduel, dkng); analysis
+    # results live next to the book data they are computed from
+    return create_psql_engine(database, (Base.metadata,) if database is not None else ())
@@ -0,0 +1 @@
+../shared/bulkload.py
\ No newline at end of file
@@ -1,33 +1,164 @@
 # azure imports 
 import azure.functions as func
 import azure.durable_functions as df  
-from azure.identity import EnvironmentCredential
-from azure.keyvault.secrets import SecretClient
-from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+from azure.storage.queue import TextBase64EncodePolicy
 
 # other imports
+import os
 import json
-import time
+import base64
+import asyncio
+import aiometer
+import functools
 import pandas as pd
+from functools import cache
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import select, update, delete, Engine, Connection, MetaData, Table
 
 # tcgds imports
 from tcgds.scrapes.dkng import sport_groups_keys, get_events as dkng_get_events, get_event_pre_fabs, get_event_sgps as dkng_get_event_sgps
 from tcgds.scrapes.fanduel import get_events as fanduel_get_events, get_event_sgps as fanduel_get_event_sgps  
 from tcgds.postgres import Postgres
 
+# local imports
+from bulkload import copy_frame
+from pending_dispatch import PendingDispatch, schedule_dispatch, metadata as pending_dispatch_metadata
+from app_resources import create_psql_engine, get_psql_credentials
+from instrumentation import record_instance, span, instrument_requests
+
 SA_NAME = "maintcgdssa"
 SA_URL = f"https://{SA_NAME}.blob.core.windows.net"
 SA_KEY_NAME = f'{SA_NAME}Key'
-KVUrl = "https://tcgdsvault.vault.azure.net/"
-credential = EnvironmentCredential()
-client = SecretClient(vault_url=KVUrl, credential=credential)
 
-# psql constants
-psql_username = client.get_secret('PSQLUsername').value
-psql_password = client.get_secret('PSQLPassword').value
-sa_key = client.get_secret(SA_KEY_NAME).value
+
+@cache
+def get_psql_engine(database:str=None) -> Engine:
+    # one pooled engine per database per process; sgp scrapes are scheduled into the default database's pending_dispatch
+    return create_psql_engine(database, (pending_dispatch_metadata,) if database is None else ())
+
+
+# sgp scrapes are released to prod2queue by the job scheduler's dispatch_pending timer at dispatch_at
+SGP_QUEUE_NAME = "prod2queue"
+SGP_QUEUE_CONN_STR_NAME = "SA_CONNECTION_STRING"
+SGP_SCRAPE_LEAD_TIME = relativedelta(minutes=7)
+
+
+def unschedule_sgp_scrapes(psql_connection:Connection, func_name:str, event_ids:list) -> int:
+    """Take `event_ids` out of the func's pending sgp scrapes, deleting the messages left without events; returns the
+    number of messages changed. A rescheduled event is scheduled again at its new time, its old scrape must not run too."""
+    event_ids = {str(event_id) for event_id in event_ids}
+    query = (
+        select(PendingDispatch.id, PendingDispatch.message)
+        .where(PendingDispatch.queue_name==SGP_QUEUE_NAME, PendingDispatch.conn_str_name==SGP_QUEUE_CONN_STR_NAME)
+        .with_for_update()
+    )
+    encoder = TextBase64EncodePolicy()
+    changed = 0
+    for row_id, message in psql_connection.execute(query).all():
+        msg_dict = json.loads(base64.b64decode(message))
+        if msg_dict['func']!=func_name:
+            continue
+        kept = [event_id for event_id in msg_dict['event_ids'] if str(event_id) not in event_ids]
+        if len(kept)==len(msg_dict['event_ids']):
+            continue
+        if kept:
+            stmt = update(PendingDispatch).where(PendingDispatch.id==row_id).values(message=encoder.encode(json.dumps(dict(msg_dict, event_ids=kept))))
+        else:
+            stmt = delete(PendingDispatch).where(PendingDispatch.id==row_id)
+        psql_connection.execute(stmt)
+        changed += 1
+    return changed
+
+
+def schedule_sgp_scrapes(psql_connection:Connection, func_name:str, events:pd.DataFrame, time_col:str):
+    # one message per event start time, dispatched SGP_SCRAPE_LEAD_TIME before the start; within the caller's transaction on the default database
+    # a rescheduled event is still pending under its old start time, it is only scraped at the new one
+    unschedule_sgp_scrapes(psql_connection, func_name, events['event_id'].to_list())
+    encoder = TextBase64EncodePolicy()
+    pending = []
+    for event_time, event_ids in events.groupby(time_col)['event_id']:
+        msg_dict = {'func':func_name, 'event_ids':event_ids.to_list()}
+        dispatch_at = pd.to_datetime(event_time, utc=True).to_pydatetime() - SGP_SCRAPE_LEAD_TIME
+        pending.append(dict(queue_name=SGP_QUEUE_NAME, conn_str_name=SGP_QUEUE_CONN_STR_NAME, message=encoder.encode(json.dumps(msg_dict)), dispatch_at=dispatch_at))
+    schedule_dispatch(psql_connection, pending)
+
+
+def store_and_schedule_events(database:str, func_name:str, events:pd.DataFrame, time_col:str):
+    """Write events to the book's events_meta and schedule their sgp scrapes, so that an event is only stored if its scrapes are queued.
+
+    events_meta and pending_dispatch live in different databases, so the scheduling transaction stays open around the
+    events_meta write and commits only after it.
+    """
+    with get_psql_engine().begin() as psql_connection:
+        schedule_sgp_scrapes(psql_connection, func_name, events, time_col)
+        pg = Postgres(*get_psql_credentials(), database)
+        with pg:
+            pg.to_sql(events, 'events_meta', 'added')
+
+
+@cache
+def _reflect_table(psql_engine:Engine, table_name:str) -> Table:
+    return Table(table_name, MetaData(), autoload_with=psql_engine)
+
+
+def filter_new_events(psql_engine:Engine, event_data:pd.DataFrame, time_col:str) -> pd.DataFrame:
+    """Drop events whose (event_id, time_col) is already in events_meta, i.e. events already stored and queued.
+
+    An event stored with another time was rescheduled and is kept, schedule_sgp_scrapes moves its pending scrape.
+    """
+    if event_data.empty:
+        return event_data
+    events_meta = _reflect_table(psql_engine, 'events_meta')
+    # bind ids as the column's own type so the event_id index can be used
+    try:
+        id_type = events_meta.c.event_id.type.python_type
+    except NotImplementedError:
+        id_type = str
+    event_ids = event_data['event_id'].drop_duplicates().map(id_type).to_list()
+    query = select(events_meta.c.event_id, events_meta.c[time_col]).where(events_meta.c.event_id.in_(event_ids)).distinct()
+    with psql_engine.connect() as psql_connection:
+        stored = pd.DataFrame(psql_connection.execute(query).all(), columns=['event_id', time_col])
+    # compare as (str id, utc time) so driver and scraper dtypes line up
+    stored_keys = set(zip(stored['event_id'].astype(str), pd.to_datetime(stored[time_col], utc=True)))
+    event_keys = zip(event_data['event_id'].astype(str), pd.to_datetime(event_data[time_col], utc=True))
+    is_new = [key not in stored_keys for key in event_keys]
+    return event_data.loc[is_new].reset_index(drop=True)
+
+
+async def fetch_concurrently(fetch_fn, args_lst:list) -> list:
+    return await asyncio.gather(*(asyncio.to_thread(fetch_fn, arg) for arg in args_lst))
+
+
+# 'copy' streams sgp frames into postgres with COPY, 'to_sql' uses the row insert path of Postgres.to_sql
+SGP_WRITE_MODE = os.environ.get('SGP_WRITE_MODE', 'copy')
+
+
+def write_frames(database:str, frames:list[tuple[pd.DataFrame, str]]):
+    if SGP_WRITE_MODE=='copy':
+        for data, table_name in frames:
+            copy_frame(get_psql_engine(database), data, table_name, time_col='added')
+    else:
+        pg = Postgres(*get_psql_credentials(), database)
+        with pg:
+            for data, table_name in frames:
+                pg.to_sql(data, table_name, 'added')
+
+
+# fanduel request budget for sgp scrapes
+FANDUEL_MAX_PER_SECOND = float(os.environ.get('FANDUEL_MAX_PER_SECOND', 0.5))
+FANDUEL_MAX_CONCURRENCY = int(os.environ.get('FANDUEL_MAX_CONCURRENCY', 4))
+
+
+async def fanduel_fetch_event_sgps(event_ids:list, max_per_second:float=FANDUEL_MAX_PER_SECOND, max_at_once:int=FANDUEL_MAX_CONCURRENCY) -> list[pd.DataFrame|Exception]:
+    # one result per event id, in order; a failed event returns its exception instead of cancelling the rest
+    async def fetch(event_id):
+        try:
+            return await asyncio.to_thread(fanduel_get_event_sgps, event_id=event_id)
+        except Exception as exc:
+            return exc
+    jobs = [functools.partial(fetch, event_id) for event_id in event_ids]
+    return await aiometer.run_all(jobs, max_at_once=max_at_once, max_per_second=max_per_second)
 
 
 app = func.FunctionApp()
@@ -36,70 +167,52 @@ app = func.FunctionApp()
 def dkng_sgp_queue_scrape(timer: func.TimerRequest):
     if timer.past_due:
         pass
-    sa_connection_string = f"DefaultEndpointsProtocol=https;AccountName={SA_NAME};AccountKey={sa_key};EndpointSuffix=core.windows.net"
-    queue = QueueClient.from_connection_string(sa_connection_string, "prod2queue")
-    dkng_pg = Postgres(psql_username, psql_password, 'dkng')
-    nba_event_data = dkng_get_events(sport_groups_keys['NBA']['eventGroupId'])
-    m_college_bball_event_data = dkng_get_events(sport_groups_keys['Men College Basketball']['eventGroupId'])
-    w_college_bball_event_data = dkng_get_events(sport_groups_keys['Women College Basketball']['eventGroupId'])
-    dkng_event_data = pd.concat([nba_event_data, m_college_bball_event_data, w_college_bball_event_data], ignore_index=True)
+    event_group_ids = [sport_groups_keys[sport]['eventGroupId'] for sport in ['NBA', 'Men College Basketball', 'Women College Basketball']]
+    dkng_event_data = pd.concat(asyncio.run(fetch_concurrently(dkng_get_events, event_group_ids)), ignore_index=True)
     now_plus_24 = datetime.utcnow()     + relativedelta(hours=24) 
     dkng_next_24hrs = dkng_event_data.loc[dkng_event_data['start_date'] <= now_plus_24].reset_index(drop=True)
+    # only store and queue events that earlier runs have not already stored and queued
+    dkng_next_24hrs = filter_new_events(get_psql_engine('dkng'), dkng_next_24hrs, 'start_date')
     if not dkng_next_24hrs.empty:
-        with dkng_pg:
-            dkng_pg.to_sql(dkng_next_24hrs, 'events_meta', 'added')
-        dkng_event_time_groups = dkng_next_24hrs.groupby('start_date')
-        dkng_event_times = dkng_event_time_groups.groups.keys()
-        for event_time in dkng_event_times:
-            dkng_event_ids = dkng_event_time_groups.get_group(event_time)['event_id'].to_list()
-            msg_dict = {'func':'dkng', 'event_ids':dkng_event_ids}
-            dkng_timeout = (event_time-datetime.utcnow()).seconds-420
-            encoder = TextBase64EncodePolicy()
-            queue.send_message(encoder.encode(json.dumps(msg_dict)), visibility_timeout=dkng_timeout)  
+        store_and_schedule_events('dkng', 'dkng', dkng_next_24hrs, 'start_date')
 
 
 @app.timer_trigger('timer', '0 0 12 * * *', run_on_startup=True)
 def fanduel_sgp_queue_scrape(timer:func.TimerRequest):
-    sa_connection_string = f"DefaultEndpointsProtocol=https;AccountName={SA_NAME};AccountKey={sa_key};EndpointSuffix=core.windows.net"
-    queue = QueueClient.from_connection_string(sa_connection_string, "prod2queue")
-    fanduel_pg = Postgres(psql_username, psql_password, 'fanduel')
-    nba_event_data:pd.DataFrame = fanduel_get_events('NBA')
-    college_bball_event_data:pd.DataFrame = fanduel_get_events('College Basketball')
-    event_data = pd.concat([nba_event_data, college_bball_event_data], ignore_index=True)
+    event_data = pd.concat(asyncio.run(fetch_concurrently(fanduel_get_events, ['NBA', 'College Basketball'])), ignore_index=True)
     now_plus_24 = datetime.utcnow() + relativedelta(hours=24)
     next_24hrs = event_data.loc[event_data['open_date'] <= now_plus_24].reset_index(drop=True)
+    # only store and queue events that earlier runs (including run_on_startup after a redeploy) have not already stored and queued
+    next_24hrs = filter_new_events(get_psql_engine('fanduel'), next_24hrs, 'open_date')
     if not next_24hrs.empty:
-        with fanduel_pg:
-            fanduel_pg.to_sql(next_24hrs, 'events_meta', 'added')    
-        event_time_groups = next_24hrs.groupby('open_date')
-        event_times = event_time_groups.groups.keys()
-        for event_time in event_times:
-            fd_evnet_ids = event_time_groups.get_group(event_time)['event_id'].to_list()
-            msg_dict = {'func':'fanduel', 'event_ids':fd_evnet_ids}
-            fanduel_timeout = (event_time-datetime.utcnow()).seconds-420
-            encoder = TextBase64EncodePolicy()
-            queue.send_message(encoder.encode(json.dumps(msg_dict)), visibility_timeout=fanduel_timeout)
+        store_and_schedule_events('fanduel', 'fanduel', next_24hrs, 'open_date')
 
 
 
 @app.queue_trigger('azqueue', queue_name="prod2queue", connection="SA_CONNECTION_STRING")
 def sgp_scrape(azqueue:func.QueueMessage):
     data_dict = json.loads(azqueue.get_body().decode('utf-8'))
-    if data_dict['func'] == "fanduel":
-        fanduel_pg = Postgres(psql_username, psql_password, 'fanduel')
-        sgp_data = pd.DataFrame()
-        for event_id in data_dict['event_ids']:
-            time.sleep(2)
-            event_sgp_data = fanduel_get_event_sgps(event_id=event_id)
-            sgp_data = pd.concat([event_sgp_data, sgp_data])
-        columns = ['type', 'betting_opportunity_id', 'total_bets', 'event_id', 'competition_id', 'selections', 'american_odds', 'decimal_odds', 'parlay_legs']
-        sgp_data = sgp_data[columns]
-        with fanduel_pg:
-            fanduel_pg.to_sql(sgp_data, 'event_sgps', 'added')
-    else:
-        dkng_pg = Postgres(psql_username, psql_password, 'dkng')
-        dkng_event_pre_fabs = get_event_pre_fabs(data_dict['event_ids'])
-        dkng_event_sgps = dkng_get_event_sgps(dkng_event_pre_fabs)
-        with dkng_pg:
-            dkng_pg.to_sql(dkng_event_pre_fabs, 'event_pre_fab_bets', 'added')
-            dkng_pg.to_sql(dkng_event_sgps, 'event_sgps', 'added')
+    with record_instance(None, f"sgp_scrape_{data_dict['func']}", get_psql_engine()):
+        # count http requests made by the sportsbook clients against the running stage, patched on first use
+        instrument_requests()
+        if data_dict['func'] == "fanduel":
+            with span('fetch_sgps') as fetch_span:
+                results = asyncio.run(fanduel_fetch_event_sgps(data_dict['event_ids']))
+                event_sgp_frames = [result for result in results if not isinstance(result, Exception)]
+                fetch_span.add(rows=sum(len(frame) for frame in event_sgp_frames))
+            # nothing is written unless every event was fetched, the host retries the whole message and would copy the others again
+            failed = [(event_id, result) for event_id, result in zip(data_dict['event_ids'], results) if isinstance(result, Exception)]
+            if failed:
+                raise RuntimeError(f'Failed to fetch fanduel sgps for {len(failed)} of {len(results)} events:\n' + '\n'.join(f'{event_id}: {exc!r}' for event_id, exc in failed))
+            columns = ['type', 'betting_opportunity_id', 'total_bets', 'event_id', 'competition_id', 'selections', 'american_odds', 'decimal_odds', 'parlay_legs']
+            if event_sgp_frames:
+                with span('write_sgps'):
+                    sgp_data = pd.concat(event_sgp_frames, ignore_index=True)[columns]
+                    write_frames('fanduel', [(sgp_data, 'event_sgps')])
+        else:
+            with span('fetch_sgps') as fetch_span:
+                dkng_event_pre_fabs = get_event_pre_fabs(data_dict['event_ids'])
+                dkng_event_sgps = dkng_get_event_sgps(dkng_event_pre_fabs)
+                fetch_span.add(rows=len(dkng_event_pre_fabs) + len(dkng_event_sgps))
+            with span('write_sgps'):
+                write_frames('dkng', [(dkng_event_pre_fabs, 'event_pre_fab_bets'), (dkng_event_sgps, 'event_sgps')])
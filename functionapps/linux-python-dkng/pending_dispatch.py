@@ -0,0 +1 @@
+../shared/pending_dispatch.py
\ No newline at end of file
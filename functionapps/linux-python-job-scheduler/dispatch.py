@@ -0,0 +1,109 @@
+# concurrent queue message dispatch and the postgres backed delayed dispatch of pending messages
+
+# azure imports
+from azure.storage.queue.aio import QueueClient as AsyncQueueClient
+
+# tcgds imports
+from tcgds.jobs import Instance, JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME
+
+# local imports
+from pending_dispatch import PendingDispatch
+
+# other
+import os
+import math
+import asyncio
+from datetime import datetime, UTC
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import Connection, select, update, delete
+
+
+QUEUE_SEND_CONCURRENCY = int(os.environ.get('QUEUE_SEND_CONCURRENCY', 16))
+# messages due within the lookahead (the dispatch timer's interval) are released with a visibility timeout for the remainder
+DISPATCH_LOOKAHEAD_SECONDS = int(os.environ.get('DISPATCH_LOOKAHEAD_SECONDS', 60))
+DISPATCH_BATCH_SIZE = int(os.environ.get('DISPATCH_BATCH_SIZE', 500))
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get('DISPATCH_MAX_ATTEMPTS', 5))
+
+
+async def _send_messages(messages:list[tuple[str, int|None]], queue_name:str, conn_str_name:str, max_concurrency:int) -> list[Exception|None]:
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with AsyncQueueClient.from_connection_string(os.environ[conn_str_name], queue_name) as queue_client:
+        async def send(content:str, visibility_timeout:int|None):
+            async with semaphore:
+                await queue_client.send_message(content, visibility_timeout=visibility_timeout)
+        return await asyncio.gather(*(send(content, timeout) for content, timeout in messages), return_exceptions=True)
+
+
+def job_message(instance_id:str, job_id, overrides:dict=None) -> dict:
+    # the worker resolves the job definition from job_id, overrides are applied on top of it
+    return {'instance_id':instance_id, 'job_id':job_id, 'overrides':overrides or {}}
+
+
+def send_messages(messages:list[tuple[str, int|None]], queue_name:str=JOBS_QUEUE_NAME, conn_str_name:str=JOBS_QUEUE_CONN_STR_NAME, max_concurrency:int=QUEUE_SEND_CONCURRENCY) -> list[Exception|None]:
+    """Send (content, visibility_timeout) pairs concurrently, at most `max_concurrency` in flight.
+
+    Returns one entry per message, in order: None when it was sent, otherwise the exception raised for it.
+    """
+    if not messages:
+        return []
+    return asyncio.run(_send_messages(messages, queue_name, conn_str_name, max_concurrency))
+
+
+def _record_results(psql_connection:Connection, results:list[tuple]) -> tuple[list, list]:
+    # sent rows are deleted, failed ones count an attempt, exhausted ones are dropped and fail their Instance
+    sent_ids = [row.id for row, exc in results if exc is None]
+    failed = [(row, exc) for row, exc in results if exc is not None]
+    exhausted = [row for row, _ in failed if row.attempts + 1>=DISPATCH_MAX_ATTEMPTS]
+    if sent_ids or exhausted:
+        psql_connection.execute(delete(PendingDispatch).where(PendingDispatch.id.in_(sent_ids + [row.id for row in exhausted])))
+    if failed:
+        stmt = update(PendingDispatch).where(PendingDispatch.id.in_([row.id for row, _ in failed])).values(attempts=PendingDispatch.attempts + 1)
+        psql_connection.execute(stmt)
+    if exhausted_instance_ids:=[row.instance_id for row in exhausted if row.instance_id is not None]:
+        psql_connection.execute(update(Instance).where(Instance.id.in_(exhausted_instance_ids)).values(status='failed'))
+    return sent_ids, failed
+
+
+def dispatch_due(psql_connection:Connection) -> tuple[int, list]:
+    """Send pending messages that are due within the lookahead, oldest first, in batches per queue.
+
+    Sent rows are deleted. Failed rows stay for the next poll until DISPATCH_MAX_ATTEMPTS, after which they are
+    dropped and their Instance marked failed. A queue that can not be reached at all (e.g. a missing connection string)
+    fails every row of its batch. Each batch is committed once sent, so rows already sent are never sent again because a
+    later queue failed. Returns the number sent and the (row, exception) failures.
+    """
+    sent_count = 0
+    failures = []
+    failed_ids = []
+    lookahead = lambda: datetime.now(tz=UTC) + relativedelta(seconds=DISPATCH_LOOKAHEAD_SECONDS)
+    queues = psql_connection.execute(select(PendingDispatch.queue_name, PendingDispatch.conn_str_name).where(PendingDispatch.dispatch_at<lookahead()).distinct()).all()
+    psql_connection.commit()
+    for queue_name, conn_str_name in queues:
+        while True:
+            time_now = datetime.now(tz=UTC)
+            query = (
+                select(PendingDispatch)
+                .where(PendingDispatch.queue_name==queue_name, PendingDispatch.conn_str_name==conn_str_name)
+                .where(PendingDispatch.dispatch_at<lookahead(), PendingDispatch.id.not_in(failed_ids))
+                .order_by(PendingDispatch.dispatch_at)
+                .limit(DISPATCH_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+            )
+            rows = psql_connection.execute(query).all()
+            if not rows:
+                break
+            messages = [(row.message, max(0, math.ceil((row.dispatch_at - time_now).total_seconds())) or None) for row in rows]
+            try:
+                send_results = send_messages(messages, queue_name, conn_str_name)
+            except Exception as exc:
+                send_results = [exc]*len(rows)
+            sent_ids, failed = _record_results(psql_connection, list(zip(rows, send_results)))
+            psql_connection.commit()
+
+            sent_count += len(sent_ids)
+            failures.extend(failed)
+            # rows that failed are retried on the next poll, not again in this one
+            failed_ids.extend(row.id for row, _ in failed)
+            if len(rows)<DISPATCH_BATCH_SIZE:
+                break
+    return sent_count, failures
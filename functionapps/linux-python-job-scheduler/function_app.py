@@ -1,36 +1,32 @@
 # azure imports 
 import azure.functions as func
-from azure.identity import EnvironmentCredential
-from azure.keyvault.secrets import SecretClient
-from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+from azure.storage.queue import TextBase64EncodePolicy
 
 # tcgds imports
-from tcgds.reporting import send_email_report, EmailExceptionHandler, pandas_to_html_col_foramtter
-from tcgds.postgres import psql_connection_string
-from tcgds.jobs import Job, Instance, JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME
+from tcgds.reporting import send_email_report, EmailExceptionHandler
+from tcgds.jobs import Job, Instance
+
+# local imports
+from resources import get_psql_engine
+from app_resources import get_queue_client
+from dispatch import job_message, dispatch_due
+from pending_dispatch import schedule_dispatch
+from schedule import sync_job_schedules, select_due_jobs, due_next_run_at, next_start_time, claim_runs, get_claimed_instance_id, advance_job_schedules
+from report import select_report_instances, select_stale_open_instances, render_instance_report, select_slowest_stages
+from instrumentation import record_instance, span
+from job_queues import job_queue
 
 
 # other
-import os
 import uuid
 import json
-import pandas as pd
 from croniter import croniter
 from datetime import datetime, UTC
 from dateutil.relativedelta import relativedelta
-from sqlalchemy import create_engine, select, insert
+from sqlalchemy import select, insert
 from contextlib import ExitStack
 
 
-azure_key_vault_string = "https://{vault_name}.vault.azure.net/"
-TCGDS_KEY_VAULT = "TCGDSVault"
-az_credential = EnvironmentCredential()
-secret_client = SecretClient(azure_key_vault_string.format(vault_name=TCGDS_KEY_VAULT), credential=az_credential)
-
-psql_username = secret_client.get_secret('PSQLUsername').value  
-psql_password = secret_client.get_secret('PSQLPassword').value
-
-
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
@@ -44,44 +40,82 @@ def queue_jobs(timer:func.TimerRequest):
         exc_handler = stack.enter_context(EmailExceptionHandler())
         base_subject = 'Job Queueing Exception:'
         exc_handler.subject = base_subject
-        psql_engine = create_engine(psql_connection_string.format(user=psql_username, password=psql_password))
-        psql_connection = stack.enter_context(psql_engine.connect())
-        queue_client = stack.enter_context(QueueClient.from_connection_string(os.environ[JOBS_QUEUE_CONN_STR_NAME], JOBS_QUEUE_NAME))
-        if timer.past_due:
-            pass
+        psql_connection = stack.enter_context(get_psql_engine().connect())
+        stack.enter_context(record_instance(None, 'queue_jobs', get_psql_engine()))
         # set times
         time_now = datetime.now(tz=UTC)
         twelve_hours_later = time_now + relativedelta(hours=12)
 
-
         exc_handler.subject = base_subject + 'Querying Job from Postgres'
-        # get Job meta data
-        q_results = psql_connection.execute((select(Job).where(Job.status=='active'))).all()
-
-        results_df = pd.DataFrame(q_results)
+        # get Job meta data for jobs whose next run falls within 12 hours
+        with span('select_due_jobs') as select_span:
+            q_results = psql_connection.execute(select_due_jobs(twelve_hours_later)).all()
+            select_span.add(rows=len(q_results))
         exc_handler.subject = base_subject
 
-        # add Job within 12 hours to queues
-        for row in results_df.iterrows():
-            cron_expr = row[1]['cron_schedule']
-                # add to Job queue 
-            if croniter.match_range(cron_expr, time_now, twelve_hours_later):
-                message = row[1].to_dict()
-                job_name = message.pop('name')
-                message['job_name'] = job_name
-                exc_handler.subject = base_subject + f'Failed to queue job {job_name}'
-                message['instance_id'] = uuid.uuid4().hex # create instance id for operation execution
-                encoder = TextBase64EncodePolicy()
-                encoded_message = encoder.encode(json.dumps(message))
-                queuetime = ((start_time:=croniter(cron_expr).get_next(datetime)) - croniter(cron_expr).get_current(datetime)).total_seconds()
-                queue_client.send_message(encoded_message, visibility_timeout=queuetime)
-                exc_handler.subject = base_subject
-                # add instance to Instance table in postgres
-                exc_handler.subject = base_subject + f'Failed to update Instance table for operation {job_name}'
-                stmt = insert(Instance).values(id=message['instance_id'], job_id=message['id'], status='queued', start_time=start_time)
+        # collect Job within 12 hours
+        encoder = TextBase64EncodePolicy()
+        due_jobs = []
+        next_run_times = {}
+        for row in q_results:
+            # a run missed by a late timer is queued at its slot and dispatched right away, older ones (e.g. job was inactive) are skipped
+            start_time = next_start_time(row.cron_schedule, due_next_run_at(row, time_now), time_now, timer.past_due)
+            if start_time>=twelve_hours_later:
+                next_run_times[row.id] = (row.cron_schedule, start_time)
+                continue
+            next_run_times[row.id] = (row.cron_schedule, croniter(row.cron_schedule, max(start_time, time_now)).get_next(datetime))
+            message = job_message(uuid.uuid4().hex, row.id) # create instance id for operation execution
+            due_jobs.append((row.function_name, message, start_time))
+
+        # add all instances to Instance table, their delayed dispatch and the advanced Job schedules in one transaction,
+        # runs already queued for the same (job_id, start_time) by an overlapping or repeated run are left as they are
+        exc_handler.subject = base_subject + f'Failed to update Instance table for {len(due_jobs)} jobs'
+        with span('insert_instances') as insert_span:
+            claimed = claim_runs(psql_connection, [dict(job_id=message['job_id'], start_time=start_time, instance_id=message['instance_id']) for _, message, start_time in due_jobs])
+            due_jobs = [due_job for due_job in due_jobs if due_job[1]['instance_id'] in claimed]
+            if due_jobs:
+                stmt = insert(Instance).values([dict(id=message['instance_id'], job_id=message['job_id'], status='queued', start_time=start_time) for _, message, start_time in due_jobs])
                 psql_connection.execute(stmt)
-                psql_connection.commit()
-                exc_handler.subject = base_subject
+                pending = []
+                for function_name, message, start_time in due_jobs:
+                    # analysis jobs go to the data analysis worker's queue
+                    queue_name, conn_str_name = job_queue(function_name)
+                    pending.append(dict(instance_id=message['instance_id'], message=encoder.encode(json.dumps(message)), dispatch_at=start_time, queue_name=queue_name, conn_str_name=conn_str_name))
+                schedule_dispatch(psql_connection, pending)
+            advance_job_schedules(psql_connection, next_run_times)
+            psql_connection.commit()
+            insert_span.add(rows=len(due_jobs))
+        exc_handler.subject = base_subject
+
+
+
+# schedule new jobs and apply cron changes of jobs that are not due yet, once a day ahead of the 11:00 queue_jobs run
+# (and on startup, so a fresh deployment has schedules); queue_jobs itself only reads the jobs that are due
+@app.timer_trigger('timer', "0 45 10 * * *", run_on_startup=True)
+def sync_schedules(timer:func.TimerRequest):
+    with ExitStack() as stack:
+        exc_handler = stack.enter_context(EmailExceptionHandler())
+        exc_handler.subject = 'Job Schedule Sync Exception:'
+        psql_connection = stack.enter_context(get_psql_engine().connect())
+        stack.enter_context(record_instance(None, 'sync_schedules', get_psql_engine()))
+        with span('sync_job_schedules') as sync_span:
+            sync_span.add(rows=sync_job_schedules(psql_connection, datetime.now(tz=UTC)))
+            psql_connection.commit()
+
+
+
+# release delayed messages whose start time has arrived
+@app.timer_trigger('timer', "0 * * * * *", run_on_startup=False)
+def dispatch_pending(timer:func.TimerRequest):
+    with ExitStack() as stack:
+        exc_handler = stack.enter_context(EmailExceptionHandler())
+        base_subject = 'Delayed Dispatch Exception:'
+        exc_handler.subject = base_subject
+        psql_connection = stack.enter_context(get_psql_engine().connect())
+        sent_count, failures = dispatch_due(psql_connection)
+        if failures:
+            exc_handler.subject = base_subject + f'Failed to send {len(failures)} of {sent_count + len(failures)} messages'
+            raise RuntimeError('\n'.join(f'{row.queue_name} {row.instance_id or row.id} (attempt {row.attempts + 1}): {exc!r}' for row, exc in failures))
 
 
 
@@ -94,35 +128,41 @@ def http_queue_jobs(req:func.HttpRequest):
             exc_handler = stack.enter_context(EmailExceptionHandler())
             base_subject = 'Job Queueing Exception:'
             exc_handler.subject = base_subject
-            psql_engine = create_engine(psql_connection_string.format(user=psql_username, password=psql_password))
-            psql_connection = stack.enter_context(psql_engine.connect())
-            queue_client = stack.enter_context(QueueClient.from_connection_string(os.environ[JOBS_QUEUE_CONN_STR_NAME], JOBS_QUEUE_NAME))
+            psql_connection = stack.enter_context(get_psql_engine().connect())
 
-            # add job to queue
             # add job to queue
             job_name:str = req.route_params.get('jobname')
             cron_start_time= req.get_json()['start_time']
-            result = psql_connection.execute(select(Job).where(Job.name==job_name)).first()
-            message = result._asdict()
+            job_id, function_name, cron_schedule = psql_connection.execute(select(Job.id, Job.function_name, Job.cron_schedule).where(Job.name==job_name)).first()
+            overrides = {}
             if cron_start_time is not None:
-                message['cron_schedule'] = cron_start_time
-            job_name = message.pop('name')
-            message['job_name'] = job_name
+                overrides['cron_schedule'] = cron_schedule = cron_start_time
             exc_handler.subject = base_subject + f'Failed to queue job {job_name}'
-            message['instance_id'] = uuid.uuid4().hex # create instance id for operation execution
+            message = job_message(uuid.uuid4().hex, job_id, overrides) # create instance id for operation execution
             encoder = TextBase64EncodePolicy()
             encoded_message = encoder.encode(json.dumps(message))
-            queuetime = ((start_time:=croniter(message['cron_schedule']).get_next(datetime)) - croniter(message['cron_schedule']).get_current(datetime)).total_seconds()
-            queue_client.send_message(encoded_message, visibility_timeout=queuetime)
-            exc_handler.subject = base_subject
-        
-            # add instance to Instance table in postgres
+            time_now = datetime.now(tz=UTC)
+            cron_iter = croniter(cron_schedule, time_now)
+            start_time = cron_iter.get_next(datetime)
+
+            # a run already queued for this slot is returned instead of queueing it again
+            if not claim_runs(psql_connection, [dict(job_id=job_id, start_time=start_time, instance_id=message['instance_id'])]):
+                psql_connection.rollback()
+                message['instance_id'] = get_claimed_instance_id(psql_connection, job_id, start_time)
+                return func.HttpResponse(json.dumps(message), status_code=200)
+
+            # add instance to Instance table in postgres, released to the queue at start_time
             exc_handler.subject = base_subject + f'Failed to update Instance table for operation {job_name}'
             stmt = (
                 insert(Instance).
-                values(id=message['instance_id'], job_id=message['id'], status='queued', start_time=start_time)
+                values(id=message['instance_id'], job_id=job_id, status='queued', start_time=start_time)
             )
             psql_connection.execute(stmt)
+            queue_name, conn_str_name = job_queue(function_name)
+            schedule_dispatch(psql_connection, [dict(instance_id=message['instance_id'], message=encoded_message, dispatch_at=start_time, queue_name=queue_name, conn_str_name=conn_str_name)])
+            if cron_start_time is None:
+                # this run takes the job's scheduled slot so the timer does not queue it again
+                advance_job_schedules(psql_connection, {job_id:(cron_schedule, cron_iter.get_next(datetime))})
             psql_connection.commit()
             exc_handler.subject = base_subject
         return func.HttpResponse(json.dumps(message), status_code=200)
@@ -139,21 +179,17 @@ def http_run_jobs(req:func.HttpRequest):
         with ExitStack() as stack:
             exc_handler = stack.enter_context(EmailExceptionHandler())
             exc_handler.subject = 'Job Run Exception'
-            psql_engine = create_engine(psql_connection_string.format(user=psql_username, password=psql_password))
-            psql_connection = stack.enter_context(psql_engine.connect())
-            queue_client = stack.enter_context(QueueClient.from_connection_string(os.environ[JOBS_QUEUE_CONN_STR_NAME], JOBS_QUEUE_NAME))
+            psql_connection = stack.enter_context(get_psql_engine().connect())
             # create queue message
             job_name:str = req.route_params.get('jobname')
-            result = psql_connection.execute(select(Job).where(Job.name==job_name)).first()
-            message = result._asdict()
-            job_name = message.pop('name')
-            message['job_name'] = job_name
-            message['instance_id'] = uuid.uuid4().hex # create instance id for operation execution
+            job_id, function_name = psql_connection.execute(select(Job.id, Job.function_name).where(Job.name==job_name)).first()
+            queue_client = get_queue_client(*job_queue(function_name))
+            message = job_message(uuid.uuid4().hex, job_id) # create instance id for operation execution
 
             # add instance to Instance table in postgres
             stmt = (
                 insert(Instance).
-                values(id=message['instance_id'], job_id=message['id'], status='queued')
+                values(id=message['instance_id'], job_id=job_id, status='queued', start_time=datetime.now(tz=UTC))
             )
             psql_connection.execute(stmt)
             psql_connection.commit()
@@ -174,22 +210,24 @@ def http_restart_instance(req:func.HttpRequest):
         with ExitStack() as stack:
             exc_handler = stack.enter_context(EmailExceptionHandler())
             exc_handler.subject = 'Instance Restarting Exception'
-            psql_engine = create_engine(psql_connection_string.format(user=psql_username, password=psql_password))
-            psql_connection = stack.enter_context(psql_engine.connect())
+            psql_connection = stack.enter_context(get_psql_engine().connect())
 
 
             instance_id:str = req.route_params.get('instanceid')
-            job_id = psql_connection.execute(select(Instance.job_id).where(Instance.id==instance_id)).first()[0]
-            q_results = psql_connection.execute(select(Job).where(Job.id == job_id)).first()
-            message = q_results._asdict()
-            job_name = message.pop('name')
-            message['job_name'] = job_name
-            message['instance_id'] = instance_id
+            query = select(Instance.job_id, Job.function_name, Instance.status).join(Job, Instance.job_id==Job.id).where(Instance.id==instance_id)
+            row = psql_connection.execute(query).first()
+            if row is None:
+                return func.HttpResponse(f'No instance with instance_id: {instance_id}', status_code=404)
+            job_id, function_name, status = row
+            # the worker drops messages of completed instances, restarting one would only look like it succeeded
+            if status=='completed':
+                return func.HttpResponse(f'Instance {instance_id} is already completed, queue the job to run it again', status_code=409)
+            message = job_message(instance_id, job_id)
 
             encoder = TextBase64EncodePolicy()
             encoded_message = encoder.encode(json.dumps(message))
 
-            queue_client = stack.enter_context(QueueClient.from_connection_string(os.environ[JOBS_QUEUE_CONN_STR_NAME], JOBS_QUEUE_NAME))
+            queue_client = get_queue_client(*job_queue(function_name))
             queue_client.send_message(encoded_message)
         return func.HttpResponse(json.dumps(message), status_code=200)
     except Exception:
@@ -206,23 +244,10 @@ def send_daily_instance_report(timer:func.TimerRequest):
         exc_handler = stack.enter_context(EmailExceptionHandler())
         exc_handler.subject = "Daily Instance Report Exception:"
 
-        pg_engine = create_engine(psql_connection_string.format(user=psql_username, password=psql_password))
-        pg_connection = stack.enter_context(pg_engine.connect())
-
-        stati_lst = ['queued', 'running', 'failed', 'completed']
-        email_body = ''
-        for status in stati_lst:            
-            if status=="completed" or status=="failed":
-                twelve_hrs_ago = (datetime.now(tz=UTC) - relativedelta(hours=12)) 
-                query = select(Job.name, Job.id, Instance.id, Instance.status, Instance.start_time, Instance.end_time, Instance.machine).join(Job, Instance.job_id==Job.id).where(Instance.status==status, Instance.end_time>=twelve_hrs_ago) 
-            else:
-                query = select(Job.name, Job.id, Instance.id, Instance.status, Instance.start_time, Instance.end_time, Instance.machine).join(Job, Instance.job_id==Job.id).where(Instance.status==status) 
-            results = pd.DataFrame(pg_connection.execute(query).all())
-            if not results.empty:
-                results.rename(columns={'id_1':'instance_id'}, inplace=True)
-                if status=='completed' or status=='failed':
-                    results['elapsed_time'] = results['end_time'] - results['start_time']
-                email_body+=f'{status.capitalize()}:<br>'
-                email_body+=results.to_html(index=False, formatters=[pandas_to_html_col_foramtter]*results.shape[1])
-                email_body+='<br>'
-        send_email_report('Daily Instance Report', email_body)
\ No newline at end of file
+        pg_connection = stack.enter_context(get_psql_engine().connect())
+
+        time_now = datetime.now(tz=UTC)
+        rows = pg_connection.execute(select_report_instances(time_now)).all()
+        stage_rows = pg_connection.execute(select_slowest_stages(time_now)).all()
+        stale_rows = pg_connection.execute(select_stale_open_instances(time_now)).all()
+        send_email_report('Daily Instance Report', render_instance_report(rows, stage_rows, stale_rows))
@@ -0,0 +1 @@
+../shared/job_queues.py
\ No newline at end of file
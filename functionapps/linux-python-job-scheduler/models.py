@@ -0,0 +1,31 @@
+# scheduler owned tables, pending_dispatch is shared with the apps that schedule messages (see pending_dispatch)
+
+# tcgds imports
+from tcgds.jobs import Job
+
+# other
+from datetime import datetime
+from sqlalchemy import ForeignKey, DateTime
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class JobSchedule(Base):
+    __tablename__ = 'job_schedule'
+
+    job_id = mapped_column(ForeignKey(Job.id, ondelete='CASCADE'), primary_key=True)
+    cron_schedule: Mapped[str] # cron expression next_run_at was computed from
+    next_run_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), index=True)
+
+
+class ScheduledRun(Base):
+    # one row per queued run of a job, the primary key makes queueing the same scheduled run twice a no-op
+    __tablename__ = 'scheduled_run'
+
+    job_id = mapped_column(ForeignKey(Job.id, ondelete='CASCADE'), primary_key=True)
+    start_time: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
+    instance_id: Mapped[str] # Instance queued for the run, inserted after its run is claimed
+
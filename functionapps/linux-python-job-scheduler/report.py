@@ -0,0 +1,139 @@
+# daily instance report built from one bounded query and rendered without pandas
+
+# tcgds imports
+from tcgds.jobs import Job, Instance
+from tcgds.reporting import pandas_to_html_col_foramtter
+
+# local imports
+from instrumentation import instance_stage_metric
+
+# other
+import os
+from html import escape
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import Engine, MetaData, Index, select, and_, or_, func
+from sqlalchemy.schema import CreateIndex
+
+
+REPORT_STATI = ['queued', 'running', 'failed', 'completed']
+# finished instances are reported for the last 12 hours, open ones back to this many days
+REPORT_OPEN_LOOKBACK_DAYS = int(os.environ.get('REPORT_OPEN_LOOKBACK_DAYS', 7))
+REPORT_SLOWEST_STAGES = int(os.environ.get('REPORT_SLOWEST_STAGES', 10))
+
+# composite indexes on tcgds' instance table backing the report's status + time range predicates, by name
+INSTANCE_REPORT_INDEXES = {
+    'ix_instance_status_end_time': ['status', 'end_time'],
+    'ix_instance_status_start_time': ['status', 'start_time'],
+}
+
+
+def create_report_indexes(psql_engine:Engine) -> None:
+    # indexes go on a private copy of the table so tcgds' metadata is left untouched, and are built concurrently so the
+    # instance table stays writable meanwhile, which postgres only allows outside a transaction
+    instance_table = Instance.__table__.to_metadata(MetaData())
+    with psql_engine.connect().execution_options(isolation_level='AUTOCOMMIT') as psql_connection:
+        for index_name, columns in INSTANCE_REPORT_INDEXES.items():
+            index = Index(index_name, *(instance_table.c[col] for col in columns), postgresql_concurrently=True)
+            psql_connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def select_report_instances(time_now:datetime):
+    twelve_hrs_ago = time_now - relativedelta(hours=12)
+    open_since = time_now - relativedelta(days=REPORT_OPEN_LOOKBACK_DAYS)
+    return (
+        select(Job.name, Job.id, Instance.id.label('instance_id'), Instance.status, Instance.start_time, Instance.end_time, Instance.machine)
+        .join(Job, Instance.job_id==Job.id)
+        .where(or_(
+            and_(Instance.status.in_(['completed', 'failed']), Instance.end_time>=twelve_hrs_ago),
+            and_(Instance.status.in_(['queued', 'running']), Instance.start_time>=open_since),
+        ))
+        .order_by(Instance.start_time)
+    )
+
+
+def select_stale_open_instances(time_now:datetime):
+    # queued or running instances older than the open lookback, counted per job so stuck runs stay visible without
+    # listing every one of them
+    open_since = time_now - relativedelta(days=REPORT_OPEN_LOOKBACK_DAYS)
+    return (
+        select(Job.name, Instance.status, func.count().label('instances'), func.min(Instance.start_time).label('oldest_start_time'))
+        .join(Job, Instance.job_id==Job.id)
+        .where(Instance.status.in_(['queued', 'running']), or_(Instance.start_time<open_since, Instance.start_time.is_(None)))
+        .group_by(Job.name, Instance.status)
+        .order_by(Job.name, Instance.status)
+    )
+
+
+def select_slowest_stages(time_now:datetime):
+    # stages recorded in the last 12 hours by their longest single run
+    twelve_hrs_ago = time_now - relativedelta(hours=12)
+    metric = instance_stage_metric.c
+    return (
+        select(metric.function_name, metric.stage, func.sum(metric.calls).label('calls'), func.sum(metric.duration_seconds).label('total_seconds'),
+               func.max(metric.max_duration_seconds).label('max_seconds'), func.sum(metric.rows).label('rows'), func.sum(metric.http_requests).label('http_requests'))
+        .where(metric.started_at>=twelve_hrs_ago)
+        .group_by(metric.function_name, metric.stage)
+        .order_by(func.max(metric.max_duration_seconds).desc())
+        .limit(REPORT_SLOWEST_STAGES)
+    )
+
+
+def _percentile(sorted_values:list, q:float):
+    # nearest rank percentile
+    return sorted_values[max(0, min(len(sorted_values)-1, round(q*len(sorted_values))-1))]
+
+
+def _html_table(columns:list[str], rows:list[list]) -> str:
+    header = ''.join(f'<th>{escape(col)}</th>' for col in columns)
+    body = ''.join('<tr>' + ''.join(f'<td>{pandas_to_html_col_foramtter(value)}</td>' for value in row) + '</tr>' for row in rows)
+    return f'<table border="1" class="dataframe"><thead><tr>{header}</tr></thead><tbody>{body}</tbody></table>'
+
+
+def render_instance_report(rows:list, stage_rows:list=(), stale_rows:list=()) -> str:
+    """Per job summary (counts by status, completed duration percentiles), open instances older than the lookback, the
+    slowest stages, then one table per status."""
+    rows_by_status = {status:[] for status in REPORT_STATI}
+    summary = {}
+    for row in rows:
+        rows_by_status.setdefault(row.status, []).append(row)
+        job_summary = summary.setdefault(row.name, {'counts':dict.fromkeys(REPORT_STATI, 0), 'durations':[]})
+        job_summary['counts'][row.status] = job_summary['counts'].get(row.status, 0) + 1
+        if row.status=='completed' and row.start_time is not None and row.end_time is not None:
+            job_summary['durations'].append(row.end_time - row.start_time)
+
+    email_body = ''
+    if summary:
+        summary_rows = []
+        for name, job_summary in sorted(summary.items()):
+            durations = sorted(job_summary['durations'])
+            percentiles = [_percentile(durations, q) if durations else None for q in (0.5, 0.9)] + [durations[-1] if durations else None]
+            summary_rows.append([name, *(job_summary['counts'][status] for status in REPORT_STATI), *percentiles])
+        email_body+='Summary:<br>'
+        email_body+=_html_table(['name', *REPORT_STATI, 'p50_elapsed_time', 'p90_elapsed_time', 'max_elapsed_time'], summary_rows)
+        email_body+='<br>'
+
+    if stale_rows:
+        email_body+=f'Open for more than {REPORT_OPEN_LOOKBACK_DAYS} days:<br>'
+        email_body+=_html_table(['name', 'status', 'instances', 'oldest_start_time'], [list(row) for row in stale_rows])
+        email_body+='<br>'
+
+    if stage_rows:
+        email_body+='Slowest stages:<br>'
+        email_body+=_html_table(['function_name', 'stage', 'calls', 'total_seconds', 'max_seconds', 'rows', 'http_requests'],
+                                [[*row[:3], round(row.total_seconds, 1), round(row.max_seconds, 1), *row[5:]] for row in stage_rows])
+        email_body+='<br>'
+
+    columns = ['name', 'id', 'instance_id', 'status', 'start_time', 'end_time', 'machine']
+    for status, status_rows in rows_by_status.items():
+        if not status_rows:
+            continue
+        table_rows = [list(row) for row in status_rows]
+        table_columns = columns
+        if status=='completed' or status=='failed':
+            table_columns = columns + ['elapsed_time']
+            table_rows = [table_row + [row.end_time - row.start_time if row.start_time is not None else None] for table_row, row in zip(table_rows, status_rows)]
+        email_body+=f'{status.capitalize()}:<br>'
+        email_body+=_html_table(table_columns, table_rows)
+        email_body+='<br>'
+    return email_body
@@ -0,0 +1,20 @@
+# process-wide resources shared by every function invocation on a worker
+
+# local imports
+from models import Base
+from report import create_report_indexes
+from instrumentation import metadata as instrumentation_metadata
+from pending_dispatch import metadata as pending_dispatch_metadata
+from app_resources import create_psql_engine
+
+# other
+from functools import cache
+from sqlalchemy import Engine
+
+
+@cache
+def get_psql_engine() -> Engine:
+    # scheduler owned tables
+    engine = create_psql_engine(metadatas=(Base.metadata, pending_dispatch_metadata, instrumentation_metadata))
+    create_report_indexes(engine)
+    return engine
@@ -0,0 +1,91 @@
+# persisted next fire time per Job so the scheduler only evaluates jobs that are due
+
+# tcgds imports
+from tcgds.jobs import Job
+
+# local imports
+from models import JobSchedule, ScheduledRun
+
+# other
+import os
+from croniter import croniter
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import Connection, select, update, or_, bindparam
+from sqlalchemy.dialects.postgresql import insert
+
+
+# a run whose slot passed less than this before the timer started is still queued (the timer fires on the slot boundary)
+SCHEDULE_GRACE_SECONDS = int(os.environ.get('SCHEDULE_GRACE_SECONDS', 300))
+# when the timer itself ran late (past_due), the latest run missed within this many hours is caught up
+SCHEDULE_CATCH_UP_HOURS = int(os.environ.get('SCHEDULE_CATCH_UP_HOURS', 12))
+
+
+def sync_job_schedules(psql_connection:Connection, time_now:datetime) -> int:
+    """Compute next_run_at for active jobs that have no schedule yet or whose cron_schedule changed.
+
+    Compares the whole catalogue, so it runs on its own slower timer; queue_jobs applies cron changes of the jobs it
+    selects as due itself (see due_next_run_at).
+    """
+    stale_query = (
+        select(Job.id, Job.cron_schedule)
+        .outerjoin(JobSchedule, JobSchedule.job_id==Job.id)
+        .where(Job.status=='active', or_(JobSchedule.job_id.is_(None), JobSchedule.cron_schedule!=Job.cron_schedule))
+    )
+    stale = psql_connection.execute(stale_query).all()
+    if stale:
+        rows = [dict(job_id=job_id, cron_schedule=cron_expr, next_run_at=croniter(cron_expr, time_now).get_next(datetime)) for job_id, cron_expr in stale]
+        stmt = insert(JobSchedule).values(rows)
+        stmt = stmt.on_conflict_do_update(index_elements=[JobSchedule.job_id], set_=dict(cron_schedule=stmt.excluded.cron_schedule, next_run_at=stmt.excluded.next_run_at))
+        psql_connection.execute(stmt)
+    return len(stale)
+
+
+def select_due_jobs(window_end:datetime):
+    # range scan on job_schedule.next_run_at instead of evaluating every cron expression
+    return (
+        select(Job.id, Job.name, Job.function_name, Job.cron_schedule, JobSchedule.next_run_at, JobSchedule.cron_schedule.label('scheduled_cron_schedule'))
+        .join(JobSchedule, JobSchedule.job_id==Job.id)
+        .where(Job.status=='active', JobSchedule.next_run_at<window_end)
+    )
+
+
+def due_next_run_at(row, time_now:datetime) -> datetime:
+    """next_run_at of a row of select_due_jobs, recomputed from now when the job's cron_schedule changed since."""
+    if row.cron_schedule!=row.scheduled_cron_schedule:
+        return croniter(row.cron_schedule, time_now).get_next(datetime)
+    return row.next_run_at
+
+
+def next_start_time(cron_schedule:str, next_run_at:datetime, time_now:datetime, past_due:bool=False) -> datetime:
+    """Scheduled start of a job's next run: next_run_at, or for a slot already passed the latest missed slot when it
+    is within the grace period (or the catch up window if the timer was past due), otherwise the next slot from now."""
+    if next_run_at>=time_now:
+        return next_run_at
+    catch_up = relativedelta(hours=SCHEDULE_CATCH_UP_HOURS) if past_due else relativedelta(seconds=SCHEDULE_GRACE_SECONDS)
+    latest_missed = croniter(cron_schedule, time_now).get_prev(datetime)
+    if latest_missed>=max(next_run_at, time_now - catch_up):
+        return latest_missed
+    return croniter(cron_schedule, time_now).get_next(datetime)
+
+
+def claim_runs(psql_connection:Connection, runs:list[dict]) -> set[str]:
+    """Record runs (job_id, start_time, instance_id), returning the instance_ids of the runs that were not already recorded."""
+    if not runs:
+        return set()
+    stmt = insert(ScheduledRun).values(runs).on_conflict_do_nothing(index_elements=[ScheduledRun.job_id, ScheduledRun.start_time]).returning(ScheduledRun.instance_id)
+    return set(psql_connection.execute(stmt).scalars())
+
+
+def get_claimed_instance_id(psql_connection:Connection, job_id, start_time:datetime) -> str|None:
+    query = select(ScheduledRun.instance_id).where(ScheduledRun.job_id==job_id, ScheduledRun.start_time==start_time)
+    return psql_connection.execute(query).scalar_one_or_none()
+
+
+def advance_job_schedules(psql_connection:Connection, next_run_times:dict) -> None:
+    """Set (cron_schedule, next_run_at) for each job_id in `next_run_times`."""
+    if not next_run_times:
+        return
+    stmt = update(JobSchedule).where(JobSchedule.job_id==bindparam('b_job_id')).values(cron_schedule=bindparam('b_cron_schedule'), next_run_at=bindparam('b_next_run_at'))
+    params = [dict(b_job_id=job_id, b_cron_schedule=cron_schedule, b_next_run_at=next_run_at) for job_id, (cron_schedule, next_run_at) in next_run_times.items()]
+    psql_connection.execute(stmt, params)
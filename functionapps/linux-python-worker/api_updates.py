@@ -0,0 +1,179 @@
+# api update jobs, imported by job_orchestrator only when one of them is dispatched
+
+# apis
+from tcgds.apis.similarweb.similarweb import Similarweb, MONTHLY_UPDATE_DAY as similarweb_mud
+from tcgds.apis.sensortower.sensortower import Sensortower, MONTHLY_UPDATE_DAY as sensortower_mud
+from tcgds.apis.whalewisdom import Whalewisdom
+
+# local imports
+from resources import get_psql_engine
+from checkpoints import checkpoint_key, get_completed_keys, mark_completed
+from shards import get_shard_items, fan_out, shard_run
+from instrumentation import span
+
+# other imports
+import os
+import json
+import asyncio
+import aiometer
+import functools
+import threading
+import time
+import pandas as pd
+from functools import cache
+from contextlib import ExitStack
+from datetime import datetime
+
+
+# budget for sensortower updates, overridable per job message: update groups running at once, and http requests per
+# second across all of them
+SENSORTOWER_MAX_CONCURRENCY = int(os.environ.get('SENSORTOWER_MAX_CONCURRENCY', 4))
+SENSORTOWER_MAX_PER_SECOND = float(os.environ.get('SENSORTOWER_MAX_PER_SECOND', 2))
+
+# rate limiter of the requests made on the current thread, set while an update group runs on it
+_thread_rate_limit = threading.local()
+
+
+def get_update_freqs(monthly_update_day:int) -> list[str]:
+    update_freqs = ['daily']
+    if (tday:=datetime.today()).weekday()==0:
+        update_freqs.append('weekly')
+    if tday.day==monthly_update_day:
+        update_freqs.append('monthly')
+        if tday.month in [1, 4, 7, 10]:
+            update_freqs.append('quarterly')
+    return update_freqs
+
+
+class RateLimiter:
+    """Token bucket shared by threads: acquire blocks until the caller may go, at most `rate` a second on average with
+    bursts of up to `burst`."""
+
+    def __init__(self, rate:float, burst:int=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        # the token is taken at once, a caller that overdraws the bucket sleeps until its token has accrued, so waiting
+        # threads are released in the order they arrived
+        with self._lock:
+            time_now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (time_now - self._updated)*self.rate)
+            self._updated = time_now
+            self._tokens -= 1
+            wait = -self._tokens/self.rate if self._tokens<0 else 0
+        if wait>0:
+            time.sleep(wait)
+
+
+@cache
+def _limit_requests() -> None:
+    # every request sent through `requests` waits for the rate limiter of its thread, if one is set
+    import requests
+
+    send = requests.Session.send
+    def limited_send(self, request, **kwargs):
+        limiter = getattr(_thread_rate_limit, 'limiter', None)
+        if limiter is not None:
+            limiter.acquire()
+        return send(self, request, **kwargs)
+    requests.Session.send = limited_send
+
+
+async def _run_isolated(update_fn, update_args_lst:list[dict], max_at_once:int, limiter:RateLimiter=None) -> list[Exception|None]:
+    # each blocking update runs in a worker thread, its requests limited by `limiter`; one failing group does not cancel the others
+    if limiter is not None:
+        _limit_requests()
+    def timed_update(update_args:dict):
+        _thread_rate_limit.limiter = limiter
+        try:
+            with span('update_data'):
+                update_fn(**update_args)
+        finally:
+            _thread_rate_limit.limiter = None
+    async def run(update_args:dict):
+        try:
+            await asyncio.to_thread(timed_update, update_args)
+        except Exception as exc:
+            return exc
+    jobs = [functools.partial(run, update_args) for update_args in update_args_lst]
+    return await aiometer.run_all(jobs, max_at_once=max_at_once)
+
+
+def _thread_clients(client_cls, stack:ExitStack):
+    # one api client per worker thread, the tcgds clients hold an http session and a db connection and are not shared across threads;
+    # every client is entered on `stack` and closed with it once the threads are done
+    local = threading.local()
+    lock = threading.Lock()
+    def get_client():
+        client = getattr(local, 'client', None)
+        if client is None:
+            with lock:
+                client = local.client = stack.enter_context(client_cls())
+        return client
+    return get_client
+
+
+def sensortower_update(json_message:dict):
+    max_at_once = int(json_message.get('max_concurrency') or SENSORTOWER_MAX_CONCURRENCY)
+    max_per_second = float(json_message.get('max_per_second') or SENSORTOWER_MAX_PER_SECOND)
+    with get_psql_engine().connect() as psql_connection, Sensortower() as sens:
+        if 'shard_index' in json_message:
+            update_args_lst = get_shard_items(psql_connection, json_message['instance_id'], json_message['shard_index'])
+        else:
+            update_args_lst = []
+            for update_freq in get_update_freqs(sensortower_mud):
+                for platform in ['unified', 'ios', 'android']:
+                    with span('get_update_params_groups'):
+                        groups = sens.get_update_params_groups(platform, update_freq)
+                    if groups is not None:
+                        for params in groups.groups.keys():
+                            first_group:pd.DataFrame = groups.get_group(params)
+                            update_args = {'app_ids':first_group['app_id'].to_list(),
+                                        'platform':platform}
+                            update_args.update(json.loads(params))
+                            update_args_lst.append(update_args)
+            if fan_out(psql_connection, json_message, update_args_lst):
+                return
+        with shard_run(psql_connection, json_message), ExitStack() as client_stack:
+            get_client = _thread_clients(Sensortower, client_stack)
+            update_data = lambda **update_args: get_client().update_data(**update_args)
+            results = asyncio.run(_run_isolated(update_data, update_args_lst, max_at_once, RateLimiter(max_per_second)))
+            failed = [(update_args, exc) for update_args, exc in zip(update_args_lst, results) if exc is not None]
+            if failed:
+                raise RuntimeError(f'{len(failed)} of {len(update_args_lst)} sensortower update groups failed:\n' + '\n'.join(f"{ {k:v for k, v in update_args.items() if k!='app_ids'} } ({len(update_args['app_ids'])} apps): {exc!r}" for update_args, exc in failed))
+
+
+def similarweb_update(json_message:dict):
+    instance_id = json_message['instance_id']
+    with get_psql_engine().connect() as psql_connection, Similarweb() as simweb:
+        if 'shard_index' in json_message:
+            update_items = get_shard_items(psql_connection, instance_id, json_message['shard_index'])
+        else:
+            update_items = []
+            for update_freq in get_update_freqs(similarweb_mud):
+                with span('get_update_params') as params_span:
+                    update_params_df = simweb.get_update_params(update_freq)
+                    params_span.add(rows=len(update_params_df))
+                update_items.extend(dict(elt, update_freq=update_freq) for elt in update_params_df.to_dict('records'))
+            if fan_out(psql_connection, json_message, update_items):
+                return
+        with shard_run(psql_connection, json_message):
+            # restarted instances resume after the last (domain, data_type, update_freq) that finished
+            completed_keys = get_completed_keys(psql_connection, instance_id)
+            for elt in update_items:
+                key = checkpoint_key(elt['domain'], elt['data_type'], elt['update_freq'])
+                if key in completed_keys:
+                    continue
+                with span('update_data'):
+                    simweb.update_data(elt['domain'], elt['data_type'], **json.loads(elt['update_params']))
+                with span('mark_completed'):
+                    mark_completed(psql_connection, instance_id, key)
+
+
+def whalewisdom_update(json_message:dict):
+    with Whalewisdom() as whale:
+        whale.update_holdings()
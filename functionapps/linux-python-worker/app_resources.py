@@ -0,0 +1 @@
+../shared/app_resources.py
\ No newline at end of file
@@ -0,0 +1,23 @@
+# per instance progress records so restarted instances skip work that already finished
+
+# local imports
+from models import InstanceCheckpoint
+
+# other imports
+from sqlalchemy import Connection, select
+from sqlalchemy.dialects.postgresql import insert
+
+
+def checkpoint_key(*parts) -> str:
+    return '|'.join(str(part) for part in parts)
+
+
+def get_completed_keys(psql_connection:Connection, instance_id:str) -> set[str]:
+    query = select(InstanceCheckpoint.key).where(InstanceCheckpoint.instance_id==instance_id)
+    return set(psql_connection.execute(query).scalars())
+
+
+def mark_completed(psql_connection:Connection, instance_id:str, key:str) -> None:
+    stmt = insert(InstanceCheckpoint).values(instance_id=instance_id, key=key).on_conflict_do_nothing()
+    psql_connection.execute(stmt)
+    psql_connection.commit()
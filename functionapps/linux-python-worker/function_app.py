@@ -1,34 +1,56 @@
-# azure imports 
+# azure imports
 import azure.functions as func
+from azure.storage.queue import TextBase64EncodePolicy
 
 # tcgds imports
 from tcgds.reporting import EmailExceptionHandler
 from tcgds.jobs import JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME
 
+# local imports
+from job_definitions import resolve_job_message
+from resources import get_psql_engine
+from app_resources import get_queue_client, instance_run
+from instrumentation import record_instance, span, instrument_requests
+from leases import max_instances, job_lease, requeue, LEASE_BUSY, LEASE_RUNNING, LEASE_COMPLETED
+from shards import failed_shards, unfinished_shards
+from job_queues import job_queue
 
-# other imports 
-import time
+
+# other imports
 import json
-import requests
-import pandas as pd 
-import requests.adapters
-from datetime import datetime
+import logging
+import importlib
+from functools import cache
 from contextlib import ExitStack
-from sqlalchemy import create_engine
-from urllib.parse import quote, unquote
-  
-
-# scrapers
-from tcgds.scrapes.dks import dks_product_scrape, dks_location_scrape
-from tcgds.scrapes.sbux import sbux_location_scrape, sbux_unionization_scrape
-# from tcgds.scrapes.five import five_location_scrape, five_product_scrape  
-# from tcgds.scrapes.bookingdotcom import bookingdotcom_location_scrape
-# from tcgds.scrapes.chtr import chtr_zipcode_scrape
-
-# apis
-from tcgds.apis.similarweb.similarweb import Similarweb, MONTHLY_UPDATE_DAY as similarweb_mud
-from tcgds.apis.sensortower.sensortower import Sensortower, MONTHLY_UPDATE_DAY as sensortower_mud
-from tcgds.apis.whalewisdom import Whalewisdom
+
+
+# job handlers by function_name as 'module:attribute', each imported the first time it is dispatched
+JOB_HANDLERS = {
+    # apis
+    'sensortower_update': 'api_updates:sensortower_update',
+    'similarweb_update': 'api_updates:similarweb_update',
+    '13f_update': 'api_updates:whalewisdom_update',
+    # scrapes
+    'dks_location_scrape': 'tcgds.scrapes.dks:dks_location_scrape',
+    'dks_product_scrape': 'tcgds.scrapes.dks:dks_product_scrape',
+    'sbux_location_scrape': 'tcgds.scrapes.sbux:sbux_location_scrape',
+    'sbux_unionization_scrape': 'tcgds.scrapes.sbux:sbux_unionization_scrape',
+    # 'five_locaton_scrape': 'tcgds.scrapes.five:five_location_scrape',
+    # 'five_product_scrape': 'tcgds.scrapes.five:five_product_scrape',
+    # 'bookingdotcom_location_scrape': 'tcgds.scrapes.bookingdotcom:bookingdotcom_location_scrape',
+    # 'chtr_zipcode_scrape': 'tcgds.scrapes.chtr:chtr_zipcode_scrape',
+}
+
+
+@cache
+def get_job_handler(function_name:str):
+    try:
+        handler_path = JOB_HANDLERS[function_name]
+    except KeyError:
+        raise ValueError(f'No job handler registered for function_name: {function_name}') from None
+    module_name, attr_name = handler_path.split(':')
+    return getattr(importlib.import_module(module_name), attr_name)
+
 
 # app initializtion
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
@@ -43,78 +65,37 @@ def job_orchestrator(message:func.QueueMessage):
     with ExitStack() as stack:
         exc_handler = stack.enter_context(EmailExceptionHandler())
         exc_handler.subject = 'Job Orchestrator'
-        
 
-        json_message = message.get_json()
+
+        raw_message = message.get_json()
+        json_message = resolve_job_message(raw_message)
         function_name = json_message['function_name']
-        exc_handler.subject = json_message['job_name'] + ' ' + json_message['instance_id']
-
-        # apis
-        if function_name == 'sensortower_update':
-            exc_handler.subject = function_name
-            update_freqs = ['daily']
-            if (tday:=datetime.today()).weekday()==0:
-                update_freqs.append('weekly')
-            if tday.day==sensortower_mud:
-                update_freqs.append('monthly')
-                if tday.month in [1, 4, 7, 10]:
-                    update_freqs.append('quarterly')
-        
-            with Sensortower() as sens:
-                for update_freq in update_freqs: 
-                    for platform in ['unified', 'ios', 'android']:
-                        groups = sens.get_update_params_groups(platform, update_freq) 
-                        if groups is not None:
-                            for params in groups.groups.keys():
-                                first_group:pd.DataFrame = groups.get_group(params) 
-                                update_args = {'app_ids':first_group['app_id'].to_list(),   
-                                            'platform':platform} 
-                                update_args.update(json.loads(params)) 
-                                sens.update_data(**update_args) 
-
-
-        if function_name == 'similarweb_update':
-            exc_handler.subject = function_name
-            update_freqs = ['daily']
-            if (tday:=datetime.today()).weekday()==0:
-                update_freqs.append('weekly')
-            if tday.day==similarweb_mud:
-                update_freqs.append('monthly')
-                if tday.month in [1, 4, 7, 10]:
-                    update_freqs.append('quarterly')
-            with Similarweb() as simweb: 
-                for update_freq in update_freqs: 
-                    update_params_df = simweb.get_update_params(update_freq)
-                    update_params_dict_lst = update_params_df.to_dict('records')
-                    for elt in update_params_dict_lst[309:]:
-                        simweb.update_data(elt['domain'], elt['data_type'], **json.loads(elt['update_params']))
-
-
-        if function_name == '13f_update':
-            with Whalewisdom() as whale:    
-                whale.update_holdings()
-
-        # scrapes
-        if function_name == 'dks_location_scrape':
-            dks_location_scrape(json_message)
-
-        if function_name == 'dks_product_scrape':
-            dks_product_scrape(json_message)
-
-        if function_name == 'sbux_location_scrape':
-            sbux_location_scrape(json_message)
-
-        if function_name == 'sbux_unionization_scrape':
-            sbux_unionization_scrape(json_message)
-
-        # if function_name == 'five_locaton_scrape':
-        #     five_location_scrape(json_message)
-
-        # if function_name == 'five_product_scrape':
-        #     five_product_scrape(json_message)
-
-        # if function_name == 'bookingdotcom_location_scrape':
-        #     bookingdotcom_location_scrape(json_message)
-
-        # if function_name == 'chtr_zipcode_scrape':
-        #     chtr_zipcode_scrape(json_message)       
\ No newline at end of file
+        instance_id = json_message['instance_id']
+        exc_handler.subject = json_message['job_name'] + ' ' + instance_id
+        # jobs of another app (e.g. analysis jobs queued here before they had their own queue) are passed on to its queue
+        queue_name, conn_str_name = job_queue(function_name)
+        if queue_name!=JOBS_QUEUE_NAME:
+            get_queue_client(queue_name, conn_str_name).send_message(TextBase64EncodePolicy().encode(json.dumps(raw_message)))
+            logging.info(f'{function_name} {instance_id} forwarded to {queue_name}')
+            return
+
+        stack.enter_context(record_instance(instance_id, function_name, get_psql_engine()))
+        psql_connection = stack.enter_context(get_psql_engine().connect())
+        lease = stack.enter_context(job_lease(psql_connection, function_name, instance_id, json_message.get('shard_index'), max_instances(json_message)))
+        # over the job type's concurrency limit, the message waits on the queue instead of running
+        if lease==LEASE_BUSY:
+            delay = requeue(raw_message)
+            logging.info(f'{function_name} {instance_id} is over its concurrency limit, requeued with a {delay}s delay')
+            return
+        # a redelivered or restarted message of a run that is still going or already done is consumed, not rerun
+        if lease in (LEASE_RUNNING, LEASE_COMPLETED):
+            logging.info(f'{function_name} {instance_id} is already {lease}, message dropped')
+            return
+        with span('import_handler'):
+            handler = get_job_handler(function_name)
+            # count http requests made by scrapes and api clients against the running stage, patched after the first
+            # handler import so requests is not imported on cold start
+            instrument_requests()
+        # an instance that fanned out to shards stays running until its last shard finishes, and fails if one failed
+        with instance_run(psql_connection, instance_id, failed_shards(instance_id), unfinished_shards(instance_id)):
+            handler(json_message)
@@ -0,0 +1 @@
+../shared/job_definitions.py
\ No newline at end of file
@@ -0,0 +1,173 @@
+# per function_name concurrency limits: a job runs only while it holds one of its type's lease slots in postgres,
+# kept alive by a heartbeat thread; messages over the limit go back on the queue with a backoff delay. An instance that
+# fans out to shards keeps its type's slot until its last shard finishes, the shards' heartbeats keep it alive; each
+# shard also leases the one slot of its own under the instance's key, so it runs only once at a time
+
+# azure imports
+from azure.storage.queue import TextBase64EncodePolicy
+
+# tcgds imports
+from tcgds.jobs import Instance
+
+# local imports
+from models import JobLease, InstanceShard
+from resources import get_psql_engine
+from app_resources import get_queue_client, MACHINE_NAME
+
+# other imports
+import os
+import json
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, UTC
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import Connection, Exists, select, update, delete, exists
+from sqlalchemy.dialects.postgresql import insert
+
+
+# concurrent instances per job type, 0 is unlimited; overridden per type by JOB_TYPE_MAX_CONCURRENCY, then by
+# JOB_MAX_CONCURRENCY_<FUNCTION_NAME> app settings and per job by max_instances in the job message
+JOB_MAX_CONCURRENCY = int(os.environ.get('JOB_MAX_CONCURRENCY', 0))
+# api updates share one rate limit per api, two instances at once only throttle each other
+JOB_TYPE_MAX_CONCURRENCY = {
+    'similarweb_update': 1,
+    'sensortower_update': 1,
+}
+# a lease whose heartbeat is older than the ttl belongs to a dead host and can be taken over
+LEASE_TTL_SECONDS = int(os.environ.get('LEASE_TTL_SECONDS', 120))
+LEASE_HEARTBEAT_SECONDS = int(os.environ.get('LEASE_HEARTBEAT_SECONDS', 30))
+# the slot of an instance with queued shards is kept this long without a heartbeat, while its shards wait on the queue
+LEASE_SHARD_WAIT_SECONDS = int(os.environ.get('LEASE_SHARD_WAIT_SECONDS', 3600))
+# requeue delay doubles per attempt up to the max
+LEASE_BACKOFF_SECONDS = int(os.environ.get('LEASE_BACKOFF_SECONDS', 30))
+LEASE_BACKOFF_MAX_SECONDS = int(os.environ.get('LEASE_BACKOFF_MAX_SECONDS', 900))
+
+# outcomes of taking a lease: only a busy message is requeued, one already running or completed is dropped
+LEASE_ACQUIRED = 'acquired'
+LEASE_BUSY = 'busy'
+LEASE_RUNNING = 'running'
+LEASE_COMPLETED = 'completed'
+
+
+def max_instances(json_message:dict) -> int:
+    if json_message.get('max_instances') is not None:
+        return int(json_message['max_instances'])
+    function_name = json_message['function_name']
+    return int(os.environ.get(f'JOB_MAX_CONCURRENCY_{function_name.upper()}', JOB_TYPE_MAX_CONCURRENCY.get(function_name, JOB_MAX_CONCURRENCY)))
+
+
+def lease_slots(function_name:str, instance_id:str, shard_index:int|None, limit:int) -> tuple[str, range]:
+    """Lease name and slots a message may take: the type's `limit` slots, or for a shard the single slot of its index
+    under its instance's own name, so the shards of one instance run in parallel but each shard only once at a time."""
+    if shard_index is not None:
+        return f'{function_name}/{instance_id}', range(shard_index, shard_index + 1)
+    return function_name, range(max(limit, 0))
+
+
+def _queued_shards(instance_id) -> Exists:
+    return exists().where(InstanceShard.instance_id==instance_id, InstanceShard.status=='queued')
+
+
+def acquire_lease(psql_connection:Connection, lease_name:str, slots:range, instance_id:str, shard_index:int|None) -> tuple[str, int|None]:
+    """Take a free or expired slot of `lease_name`, returning (LEASE_ACQUIRED, slot), with no slot when `slots` is
+    empty; otherwise (LEASE_BUSY, None) when all `slots` are held, or (LEASE_RUNNING / LEASE_COMPLETED, None) when the
+    same instance (shard) already holds a slot or has completed, e.g. a redelivered or restarted message."""
+    # lock the instance so two deliveries of it can not both pass the checks below
+    status = psql_connection.execute(select(Instance.status).where(Instance.id==instance_id).with_for_update()).scalar()
+    if shard_index is not None:
+        status = psql_connection.execute(select(InstanceShard.status).where(InstanceShard.instance_id==instance_id, InstanceShard.shard_index==shard_index)).scalar()
+    time_now = datetime.now(tz=UTC)
+    expired = time_now - relativedelta(seconds=LEASE_TTL_SECONDS)
+    running = select(JobLease.slot).where(JobLease.instance_id==instance_id, JobLease.shard_index.is_not_distinct_from(shard_index), JobLease.heartbeat_at>=expired)
+    if status=='completed':
+        outcome, slot = LEASE_COMPLETED, None
+    elif psql_connection.execute(running).first() is not None:
+        outcome, slot = LEASE_RUNNING, None
+    elif not slots:
+        outcome, slot = LEASE_ACQUIRED, None
+    else:
+        outcome, slot = LEASE_BUSY, None
+        # a slot held for queued shards only expires after the longer shard wait
+        waiting = select(JobLease.slot).where(
+            JobLease.function_name==lease_name,
+            JobLease.heartbeat_at>=time_now - relativedelta(seconds=LEASE_SHARD_WAIT_SECONDS),
+            _queued_shards(JobLease.instance_id),
+        )
+        waiting_slots = set(psql_connection.execute(waiting).scalars())
+        for candidate in slots:
+            if candidate in waiting_slots:
+                continue
+            stmt = insert(JobLease).values(function_name=lease_name, slot=candidate, instance_id=instance_id, shard_index=shard_index, machine=MACHINE_NAME, heartbeat_at=time_now)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[JobLease.function_name, JobLease.slot],
+                set_=dict(instance_id=stmt.excluded.instance_id, shard_index=stmt.excluded.shard_index, machine=stmt.excluded.machine, heartbeat_at=stmt.excluded.heartbeat_at),
+                where=JobLease.heartbeat_at<expired,
+            ).returning(JobLease.slot)
+            if psql_connection.execute(stmt).first() is not None:
+                outcome, slot = LEASE_ACQUIRED, candidate
+                break
+    psql_connection.commit()
+    return outcome, slot
+
+
+def _lease_filter(lease_name:str, slot:int, instance_id:str) -> list:
+    return [JobLease.function_name==lease_name, JobLease.slot==slot, JobLease.instance_id==instance_id]
+
+
+def _heartbeat(lease_name:str, slot:int, instance_id:str, shard_index:int|None, stop:threading.Event) -> None:
+    while not stop.wait(LEASE_HEARTBEAT_SECONDS):
+        try:
+            with get_psql_engine().begin() as psql_connection:
+                time_now = datetime.now(tz=UTC)
+                stmt = update(JobLease).where(*_lease_filter(lease_name, slot, instance_id)).values(heartbeat_at=time_now)
+                if psql_connection.execute(stmt).rowcount==0:
+                    logging.warning(f'Lease {lease_name}[{slot}] of {instance_id} expired and was taken over')
+                # a running shard keeps its instance's type slot alive as well
+                if shard_index is not None:
+                    stmt = update(JobLease).where(JobLease.instance_id==instance_id, JobLease.shard_index.is_(None)).values(heartbeat_at=time_now)
+                    psql_connection.execute(stmt)
+        except Exception:
+            logging.exception(f'Failed to heartbeat lease {lease_name}[{slot}] of {instance_id}')
+
+
+@contextmanager
+def job_lease(psql_connection:Connection, function_name:str, instance_id:str, shard_index:int|None, limit:int):
+    """Hold a slot of `function_name` (see lease_slots) for the block and yield the acquire_lease outcome; nothing is
+    held unless it is LEASE_ACQUIRED, nor for an unlimited job type. The type slot of an instance that fanned out to
+    shards is kept after the block, the last shard to finish releases it (see release_shard_parent)."""
+    lease_name, slots = lease_slots(function_name, instance_id, shard_index, limit)
+    outcome, slot = acquire_lease(psql_connection, lease_name, slots, instance_id, shard_index)
+    if slot is None:
+        yield outcome
+        return
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(lease_name, slot, instance_id, shard_index, stop), daemon=True)
+    heartbeat.start()
+    try:
+        yield outcome
+    finally:
+        stop.set()
+        heartbeat.join()
+        release = delete(JobLease).where(*_lease_filter(lease_name, slot, instance_id))
+        if shard_index is None:
+            release = release.where(~_queued_shards(instance_id))
+        with get_psql_engine().begin() as release_connection:
+            release_connection.execute(release)
+
+
+def release_shard_parent(psql_connection:Connection, instance_id:str) -> None:
+    """Release the type slot held for the shards of `instance_id` once none is queued any more."""
+    stmt = delete(JobLease).where(JobLease.instance_id==instance_id, JobLease.shard_index.is_(None), ~_queued_shards(instance_id))
+    psql_connection.execute(stmt)
+
+
+def requeue(raw_message:dict) -> int:
+    """Send the message back to the jobs queue, visible again after a jittered exponential backoff; returns the delay."""
+    attempts = int(raw_message.get('lease_attempts', 0))
+    delay = min(LEASE_BACKOFF_SECONDS*2**attempts, LEASE_BACKOFF_MAX_SECONDS)
+    delay = round(delay*random.uniform(0.75, 1.25)) # spread requeued messages so they do not all return at once
+    encoder = TextBase64EncodePolicy()
+    get_queue_client().send_message(encoder.encode(json.dumps(dict(raw_message, lease_attempts=attempts + 1))), visibility_timeout=delay)
+    return delay
@@ -0,0 +1,44 @@
+# worker owned tables
+
+# tcgds imports
+from tcgds.jobs import Instance
+
+# other imports
+from datetime import datetime
+from sqlalchemy import ForeignKey, DateTime, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class InstanceCheckpoint(Base):
+    __tablename__ = 'instance_checkpoint'
+
+    instance_id = mapped_column(ForeignKey(Instance.id, ondelete='CASCADE'), primary_key=True)
+    key: Mapped[str] = mapped_column(primary_key=True)
+    completed_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+class InstanceShard(Base):
+    __tablename__ = 'instance_shard'
+
+    instance_id = mapped_column(ForeignKey(Instance.id, ondelete='CASCADE'), primary_key=True)
+    shard_index: Mapped[int] = mapped_column(primary_key=True)
+    items: Mapped[list] = mapped_column(JSONB) # work items handled by this shard
+    status: Mapped[str] = mapped_column(default='queued')
+    end_time: Mapped[datetime|None] = mapped_column(DateTime(timezone=True))
+
+
+class JobLease(Base):
+    # one row per leased concurrency slot of a job type, held while heartbeat_at is fresh
+    __tablename__ = 'job_lease'
+
+    function_name: Mapped[str] = mapped_column(primary_key=True) # lease name, function_name/instance_id for shards
+    slot: Mapped[int] = mapped_column(primary_key=True)
+    instance_id: Mapped[str]
+    shard_index: Mapped[int|None]
+    machine: Mapped[str]
+    heartbeat_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
@@ -0,0 +1,15 @@
+# process-wide resources shared by every function invocation on a worker
+
+# local imports
+from models import Base
+from app_resources import create_psql_engine
+
+# other
+from functools import cache
+from sqlalchemy import Engine
+
+
+@cache
+def get_psql_engine() -> Engine:
+    # worker owned tables
+    return create_psql_engine(metadatas=(Base.metadata,))
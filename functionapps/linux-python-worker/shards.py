@@ -0,0 +1,98 @@
+# split large jobs into shard messages on the jobs queue and complete the parent instance when every shard finishes
+
+# azure imports
+from azure.storage.queue import TextBase64EncodePolicy
+
+# tcgds imports
+from tcgds.jobs import Instance
+
+# local imports
+from models import InstanceShard
+from app_resources import get_queue_client
+from leases import release_shard_parent
+
+# other imports
+import os
+import json
+from contextlib import contextmanager
+from datetime import datetime, UTC
+from sqlalchemy import Connection, Exists, select, update, exists, func
+
+
+# work items per shard, 0 disables sharding; a job message can override it with shard_size
+JOB_SHARD_SIZE = int(os.environ.get('JOB_SHARD_SIZE', 0))
+
+
+def get_shard_items(psql_connection:Connection, instance_id:str, shard_index:int) -> list:
+    query = select(InstanceShard.items).where(InstanceShard.instance_id==instance_id, InstanceShard.shard_index==shard_index)
+    return psql_connection.execute(query).scalar_one()
+
+
+def failed_shards(instance_id:str) -> Exists:
+    return exists().where(InstanceShard.instance_id==instance_id, InstanceShard.status=='failed')
+
+
+def unfinished_shards(instance_id:str) -> Exists:
+    return exists().where(InstanceShard.instance_id==instance_id, InstanceShard.status!='completed')
+
+
+def fan_out(psql_connection:Connection, json_message:dict, items:list) -> bool:
+    """Queue shard messages for `items` when they exceed the job's shard size.
+
+    Returns True if the work was handed to shards, False if the caller should process `items` itself.
+    A parent that already has shards (e.g. a restarted instance) only requeues the shards that have not completed.
+    """
+    shard_size = int(json_message.get('shard_size') or JOB_SHARD_SIZE)
+    if shard_size<=0 or len(items)<=shard_size:
+        return False
+    instance_id = json_message['instance_id']
+    existing = psql_connection.execute(select(InstanceShard.shard_index, InstanceShard.status).where(InstanceShard.instance_id==instance_id)).all()
+    if existing:
+        shard_indexes = [shard_index for shard_index, status in existing if status!='completed']
+        stmt = update(InstanceShard).where(InstanceShard.instance_id==instance_id, InstanceShard.shard_index.in_(shard_indexes)).values(status='queued')
+        psql_connection.execute(stmt)
+    else:
+        shards = [items[i:i+shard_size] for i in range(0, len(items), shard_size)]
+        shard_indexes = list(range(len(shards)))
+        psql_connection.execute(InstanceShard.__table__.insert(), [dict(instance_id=instance_id, shard_index=i, items=shard, status='queued') for i, shard in enumerate(shards)])
+    psql_connection.commit()
+
+    queue_client = get_queue_client()
+    encoder = TextBase64EncodePolicy()
+    shard_count = len(existing) or len(shard_indexes)
+    for shard_index in shard_indexes:
+        overrides = dict(json_message.get('overrides') or {}, shard_index=shard_index, shard_count=shard_count)
+        shard_message = {'instance_id':instance_id, 'job_id':json_message['id'], 'overrides':overrides}
+        queue_client.send_message(encoder.encode(json.dumps(shard_message)))
+    return True
+
+
+def _finish_shard(psql_connection:Connection, instance_id:str, shard_index:int, status:str) -> None:
+    # lock the parent so concurrently finishing shards see each other's status
+    psql_connection.execute(select(Instance.id).where(Instance.id==instance_id).with_for_update())
+    time_now = datetime.now(tz=UTC)
+    stmt = update(InstanceShard).where(InstanceShard.instance_id==instance_id, InstanceShard.shard_index==shard_index).values(status=status, end_time=time_now)
+    psql_connection.execute(stmt)
+    if status=='completed':
+        remaining = psql_connection.execute(select(func.count()).where(InstanceShard.instance_id==instance_id, InstanceShard.status!='completed')).scalar_one()
+        if remaining==0:
+            psql_connection.execute(update(Instance).where(Instance.id==instance_id).values(status='completed', end_time=time_now))
+    # the parent held its job type's slot for its shards until the last one finishes
+    release_shard_parent(psql_connection, instance_id)
+    psql_connection.commit()
+
+
+@contextmanager
+def shard_run(psql_connection:Connection, json_message:dict):
+    """Record the outcome of a shard message's work; a no-op for messages that are not shards."""
+    shard_index = json_message.get('shard_index')
+    if shard_index is None:
+        yield
+        return
+    try:
+        yield
+    except Exception:
+        psql_connection.rollback()
+        _finish_shard(psql_connection, json_message['instance_id'], shard_index, 'failed')
+        raise
+    _finish_shard(psql_connection, json_message['instance_id'], shard_index, 'completed')
@@ -0,0 +1,99 @@
+# process-wide resources shared by every function invocation of an app: key vault secrets, pooled psql engines, queue
+# clients and the Instance status of a run
+#
+# symlinked into the function apps that use it (the deploy workflow copies the target), import it as `app_resources`;
+# each app's get_psql_engine binds create_psql_engine to the tables it owns
+
+# azure imports
+from azure.identity import EnvironmentCredential
+from azure.keyvault.secrets import SecretClient
+from azure.storage.queue import QueueClient
+
+# tcgds imports
+from tcgds.postgres import psql_connection_string
+from tcgds.jobs import Instance, JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME
+
+# other imports
+import os
+import socket
+from functools import cache
+from contextlib import contextmanager
+from datetime import datetime, UTC
+from sqlalchemy import create_engine, make_url, update, Engine, Connection, MetaData, Exists
+
+
+azure_key_vault_string = "https://{vault_name}.vault.azure.net/"
+TCGDS_KEY_VAULT = "TCGDSVault"
+
+# psql pool settings, overridable through app settings
+PSQL_POOL_SIZE = int(os.environ.get('PSQL_POOL_SIZE', 5))
+PSQL_MAX_OVERFLOW = int(os.environ.get('PSQL_MAX_OVERFLOW', 5))
+PSQL_POOL_TIMEOUT = int(os.environ.get('PSQL_POOL_TIMEOUT', 30))
+PSQL_POOL_RECYCLE = int(os.environ.get('PSQL_POOL_RECYCLE', 1800))
+
+MACHINE_NAME = os.environ.get('WEBSITE_INSTANCE_ID') or socket.gethostname()
+
+
+@cache
+def get_secret_client() -> SecretClient:
+    return SecretClient(azure_key_vault_string.format(vault_name=TCGDS_KEY_VAULT), credential=EnvironmentCredential())
+
+
+@cache
+def get_psql_credentials() -> tuple[str, str]:
+    secret_client = get_secret_client()
+    return secret_client.get_secret('PSQLUsername').value, secret_client.get_secret('PSQLPassword').value
+
+
+def create_psql_engine(database:str=None, metadatas:tuple[MetaData, ...]=()) -> Engine:
+    """A pooled engine on `database`, the default database when None, with the tables of `metadatas` created.
+
+    Apps cache one per database per process; pre-ping drops connections killed by the server or idle timeouts.
+    """
+    psql_username, psql_password = get_psql_credentials()
+    url = make_url(psql_connection_string.format(user=psql_username, password=psql_password))
+    if database is not None:
+        url = url.set(database=database)
+    engine = create_engine(
+        url,
+        pool_size=PSQL_POOL_SIZE,
+        max_overflow=PSQL_MAX_OVERFLOW,
+        pool_timeout=PSQL_POOL_TIMEOUT,
+        pool_recycle=PSQL_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+    for metadata in metadatas:
+        metadata.create_all(engine)
+    return engine
+
+
+@cache
+def get_queue_client(queue_name:str=JOBS_QUEUE_NAME, conn_str_name:str=JOBS_QUEUE_CONN_STR_NAME) -> QueueClient:
+    # queue clients keep their http session open, so reuse one per queue instead of closing it per request
+    return QueueClient.from_connection_string(os.environ[conn_str_name], queue_name)
+
+
+@contextmanager
+def instance_run(psql_connection:Connection, instance_id:str, failed_when:Exists=None, unfinished_when:Exists=None):
+    """Mark the Instance running on this machine for the block, then completed, or failed if the block raises.
+
+    An instance whose work goes on elsewhere (e.g. in shards) fails when `failed_when` holds once the block is done,
+    and stays running while `unfinished_when` holds.
+    """
+    psql_connection.execute(update(Instance).where(Instance.id==instance_id).values(status='running', machine=MACHINE_NAME))
+    psql_connection.commit()
+    try:
+        yield
+    except Exception:
+        psql_connection.rollback()
+        psql_connection.execute(update(Instance).where(Instance.id==instance_id).values(status='failed', end_time=datetime.now(tz=UTC)))
+        psql_connection.commit()
+        raise
+    time_now = datetime.now(tz=UTC)
+    if failed_when is not None:
+        psql_connection.execute(update(Instance).where(Instance.id==instance_id, failed_when).values(status='failed', end_time=time_now))
+    completed = update(Instance).where(Instance.id==instance_id, Instance.status=='running')
+    if unfinished_when is not None:
+        completed = completed.where(~unfinished_when)
+    psql_connection.execute(completed.values(status='completed', end_time=time_now))
+    psql_connection.commit()
@@ -0,0 +1,114 @@
+# COPY based bulk loading of DataFrames into Postgres
+#
+# symlinked into the function apps that use it (the deploy workflow copies the target), import it as `bulkload`
+
+# other imports
+import io
+import json
+import time
+import logging
+import pandas as pd
+from datetime import datetime
+from sqlalchemy import Engine, ARRAY, inspect
+
+
+COPY_CHUNK_SIZE = 50_000
+# written for missing values, so empty strings stay empty strings (an unquoted empty csv field would be NULL)
+COPY_NULL = r'\N'
+
+
+def _quote_ident(name:str) -> str:
+    return '.'.join('"' + part.replace('"', '""') + '"' for part in name.split('.'))
+
+
+def _array_literal(values:list) -> str:
+    # postgres array input syntax, as psycopg2 adapts a python list bound to an array column
+    def element(value):
+        if value is None:
+            return 'NULL'
+        if isinstance(value, (list, tuple)):
+            return _array_literal(value)
+        if isinstance(value, dict):
+            value = json.dumps(value)
+        return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return '{' + ','.join(element(value) for value in values) + '}'
+
+
+def _column_encoders(psql_connection, table_name:str) -> dict:
+    """Encoder per column of `table_name` for the nested values (lists, dicts) in it, matching the column's own type:
+    json/jsonb columns take json text and array columns the array literal psycopg2 would bind, as Postgres.to_sql
+    writes them. Nested values bound to any other column type are written as json text."""
+    schema, _, name = table_name.rpartition('.')
+    encoders = {}
+    for col in inspect(psql_connection).get_columns(name, schema=schema or None):
+        if isinstance(col['type'], ARRAY):
+            encoders[col['name']] = lambda value: _array_literal(value) if isinstance(value, (list, tuple)) else json.dumps(value)
+    return encoders
+
+
+def _to_csv_chunk(chunk:pd.DataFrame, encoders:dict) -> io.StringIO:
+    chunk = chunk.copy()
+    for col in chunk.columns[chunk.dtypes==object]:
+        encode = encoders.get(col, json.dumps)
+        chunk[col] = chunk[col].map(lambda value: encode(value) if isinstance(value, (list, tuple, dict)) else value)
+    # integer columns that picked up NaN are floats in pandas; write them without the .0 so integer columns accept them
+    for col in chunk.columns[chunk.dtypes==float]:
+        if (chunk[col].dropna()%1==0).all():
+            chunk[col] = chunk[col].astype('Int64')
+    buffer = io.StringIO()
+    chunk.to_csv(buffer, index=False, header=False, na_rep=COPY_NULL)
+    buffer.seek(0)
+    return buffer
+
+
+def _copy(cursor, sql:str, buffer:io.StringIO) -> None:
+    if hasattr(cursor, 'copy_expert'): # psycopg2
+        cursor.copy_expert(sql, buffer)
+    else: # psycopg 3
+        with cursor.copy(sql) as copy:
+            copy.write(buffer.getvalue())
+
+
+def copy_frame(psql_engine:Engine, data:pd.DataFrame, table_name:str, time_col:str=None, conflict_cols:list[str]=None,
+               update_set:dict[str, str]=None, update_where:str=None, chunk_size:int=COPY_CHUNK_SIZE) -> int:
+    """Stream `data` into `table_name` with COPY, `chunk_size` rows at a time, in one transaction.
+
+    `time_col` is stamped with the load time like Postgres.to_sql does. With `conflict_cols` the rows are copied into
+    a temporary staging table and inserted with ON CONFLICT DO NOTHING, or with `update_set` (column -> sql expression
+    over `target`, the existing row, and `EXCLUDED`, the new one) ON CONFLICT DO UPDATE, of the rows where `update_where`
+    holds when given. Returns the rows copied.
+    """
+    if data.empty:
+        return 0
+    columns = list(data.columns) + ([time_col] if time_col is not None and time_col not in data.columns else [])
+    column_list = ', '.join(_quote_ident(col) for col in columns)
+    target = _quote_ident(table_name)
+    loaded_at = datetime.utcnow()
+    start = time.perf_counter()
+    if conflict_cols:
+        conflict_list = ', '.join(_quote_ident(col) for col in conflict_cols)
+        if update_set:
+            on_conflict = f'ON CONFLICT ({conflict_list}) DO UPDATE SET ' + ', '.join(f'{_quote_ident(col)} = {expr}' for col, expr in update_set.items())
+            if update_where:
+                on_conflict += f' WHERE {update_where}'
+        else:
+            on_conflict = f'ON CONFLICT ({conflict_list}) DO NOTHING'
+    with psql_engine.begin() as psql_connection:
+        encoders = _column_encoders(psql_connection, table_name)
+        cursor = psql_connection.connection.cursor()
+        copy_target = target
+        if conflict_cols:
+            copy_target = _quote_ident('staging_' + table_name.split('.')[-1])
+            cursor.execute(f'CREATE TEMP TABLE {copy_target} (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP')
+        for i in range(0, len(data), chunk_size):
+            chunk = data.iloc[i:i+chunk_size]
+            if time_col is not None:
+                chunk = chunk.assign(**{time_col:loaded_at})
+            _copy(cursor, f"COPY {copy_target} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", _to_csv_chunk(chunk[columns], encoders))
+            if conflict_cols:
+                cursor.execute(f'INSERT INTO {target} AS target ({column_list}) SELECT {column_list} FROM {copy_target} {on_conflict}')
+                cursor.execute(f'TRUNCATE {copy_target}')
+        cursor.close()
+    elapsed = time.perf_counter() - start
+    logging.info(f'Copied {len(data)} rows into {table_name} in {elapsed:.1f}s ({len(data)/max(elapsed, 1e-9):,.0f} rows/sec)')
+    return len(data)
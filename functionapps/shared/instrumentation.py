@@ -0,0 +1,183 @@
+# per stage timing spans shared by the function apps
+#
+# symlinked into the function apps that use it (the deploy workflow copies the target), import it as `instrumentation`
+
+# other imports
+import os
+import time
+import logging
+import threading
+import contextvars
+from functools import cache
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+from datetime import datetime, UTC
+from sqlalchemy import Engine, MetaData, Table, Column, BigInteger, Identity, String, DateTime, Float, Integer
+
+
+# stage durations are also exported to application insights as custom metrics when the host has a connection string
+APPLICATIONINSIGHTS_CONNECTION_STRING = os.environ.get('APPLICATIONINSIGHTS_CONNECTION_STRING')
+
+metadata = MetaData()
+instance_stage_metric = Table(
+    'instance_stage_metric', metadata,
+    Column('id', BigInteger, Identity(), primary_key=True),
+    Column('instance_id', String, index=True),
+    Column('function_name', String, nullable=False),
+    Column('stage', String, nullable=False),
+    Column('started_at', DateTime(timezone=True), nullable=False, index=True),
+    Column('calls', Integer, nullable=False),
+    Column('duration_seconds', Float, nullable=False),
+    Column('max_duration_seconds', Float, nullable=False),
+    Column('rows', BigInteger, nullable=False),
+    Column('http_requests', Integer, nullable=False),
+    Column('http_bytes', BigInteger, nullable=False),
+)
+
+_counter_lock = threading.Lock()
+_current_span = contextvars.ContextVar('current_span', default=None)
+_current_recorder = contextvars.ContextVar('current_recorder', default=None)
+
+
+@dataclass
+class Span:
+    stage: str # '/' separated path of the enclosing span names
+    started_at: datetime
+    parent: 'Span' = None
+    duration: float = 0.0
+    rows: int = 0
+    http_requests: int = 0
+    http_bytes: int = 0
+
+    def add(self, rows:int=0, http_requests:int=0, http_bytes:int=0) -> None:
+        # counts roll up into every enclosing span
+        with _counter_lock:
+            span = self
+            while span is not None:
+                span.rows += rows
+                span.http_requests += http_requests
+                span.http_bytes += http_bytes
+                span = span.parent
+
+
+@dataclass
+class Recorder:
+    instance_id: str
+    function_name: str
+    spans: list = field(default_factory=list)
+
+    def stage_metrics(self) -> list[dict]:
+        # repeated spans of the same stage (e.g. one per work item) are aggregated into one row
+        stages = {}
+        for span in self.spans:
+            metric = stages.setdefault(span.stage, dict(instance_id=self.instance_id, function_name=self.function_name, stage=span.stage, started_at=span.started_at,
+                                                        calls=0, duration_seconds=0.0, max_duration_seconds=0.0, rows=0, http_requests=0, http_bytes=0))
+            metric['started_at'] = min(metric['started_at'], span.started_at)
+            metric['calls'] += 1
+            metric['duration_seconds'] += span.duration
+            metric['max_duration_seconds'] = max(metric['max_duration_seconds'], span.duration)
+            metric['rows'] += span.rows
+            metric['http_requests'] += span.http_requests
+            metric['http_bytes'] += span.http_bytes
+        return list(stages.values())
+
+
+@contextmanager
+def span(name:str):
+    """Time the enclosed block as a stage of the current recording; yields the Span so callers can add counts."""
+    parent = _current_span.get()
+    current = Span(stage=name if parent is None else f'{parent.stage}/{name}', started_at=datetime.now(tz=UTC), parent=parent)
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        recorder = _current_recorder.get()
+        if recorder is not None:
+            recorder.spans.append(current)
+
+
+def add_counts(rows:int=0, http_requests:int=0, http_bytes:int=0) -> None:
+    """Add counts to the innermost open span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.add(rows=rows, http_requests=http_requests, http_bytes=http_bytes)
+
+
+@cache
+def _create_metric_table(psql_engine:Engine) -> None:
+    metadata.create_all(psql_engine)
+
+
+@cache
+def _metric_exporter():
+    # set up on first export rather than at import, the opentelemetry sdk and exporter are slow to import
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+    from azure.monitor.opentelemetry.exporter import AzureMonitorMetricExporter
+
+    exporter = AzureMonitorMetricExporter(connection_string=APPLICATIONINSIGHTS_CONNECTION_STRING)
+    meter_provider = MeterProvider(metric_readers=[PeriodicExportingMetricReader(exporter)])
+    histogram = meter_provider.get_meter('tcgds.functionapps').create_histogram('stage_duration_seconds', unit='s', description='Wall time per function stage')
+    return meter_provider, histogram
+
+
+def _export_custom_metrics(stage_metrics:list[dict]) -> None:
+    meter_provider, histogram = _metric_exporter()
+    for metric in stage_metrics:
+        histogram.record(metric['duration_seconds'], {'function_name':metric['function_name'], 'stage':metric['stage']})
+    # flushed per invocation, the host may recycle the process before the periodic reader's next export
+    meter_provider.force_flush()
+
+
+def export_metrics(stage_metrics:list[dict], psql_engine:Engine=None) -> None:
+    """Write stage metrics to postgres (or the log when no engine is given) and export them as application insights
+    custom metrics when APPLICATIONINSIGHTS_CONNECTION_STRING is set."""
+    for metric in stage_metrics:
+        if psql_engine is None:
+            logging.info(f"stage metric {metric['function_name']} {metric['stage']} instance={metric['instance_id']} calls={metric['calls']} "
+                         f"duration={metric['duration_seconds']:.3f}s rows={metric['rows']} http_requests={metric['http_requests']} http_bytes={metric['http_bytes']}")
+    if psql_engine is not None and stage_metrics:
+        _create_metric_table(psql_engine)
+        with psql_engine.begin() as psql_connection:
+            psql_connection.execute(instance_stage_metric.insert(), stage_metrics)
+    if APPLICATIONINSIGHTS_CONNECTION_STRING and stage_metrics:
+        _export_custom_metrics(stage_metrics)
+
+
+@contextmanager
+def record_instance(instance_id:str, function_name:str, psql_engine:Engine=None):
+    """Record every span opened inside the block, under a root span named `function_name`, and export them on exit.
+
+    Exporting never raises, so instrumentation can not fail the function it measures.
+    """
+    recorder = Recorder(instance_id, function_name)
+    token = _current_recorder.set(recorder)
+    try:
+        with span(function_name):
+            yield recorder
+    finally:
+        _current_recorder.reset(token)
+        try:
+            export_metrics(recorder.stage_metrics(), psql_engine)
+        except Exception:
+            logging.exception(f'Failed to export stage metrics for {function_name} {instance_id}')
+
+
+@cache
+def instrument_requests() -> None:
+    """Count http requests and response bytes made through `requests` against the current span."""
+    import requests
+
+    send = requests.Session.send
+    def counted_send(self, request, **kwargs):
+        response = send(self, request, **kwargs)
+        if kwargs.get('stream'):
+            http_bytes = int(response.headers.get('Content-Length') or 0)
+        else:
+            http_bytes = len(response.content or b'')
+        add_counts(http_requests=1, http_bytes=http_bytes)
+        return response
+    requests.Session.send = counted_send
@@ -0,0 +1,58 @@
+# resolve compact queue messages into full job messages through an in-process lru/ttl cache of Job rows
+#
+# symlinked into the function apps that use it (the deploy workflow copies the target); reads Job through the app's own resources.get_psql_engine
+
+# tcgds imports
+from tcgds.jobs import Job
+
+# local imports
+from resources import get_psql_engine
+
+# other imports
+import os
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy import select
+
+
+JOB_DEFINITION_CACHE_TTL = int(os.environ.get('JOB_DEFINITION_CACHE_TTL', 300))
+JOB_DEFINITION_CACHE_SIZE = int(os.environ.get('JOB_DEFINITION_CACHE_SIZE', 256))
+
+_cache:OrderedDict = OrderedDict() # job_id -> (expires_at, definition)
+_cache_lock = threading.Lock()
+
+
+def get_job_definition(job_id) -> dict:
+    time_now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(job_id)
+        if cached is not None and cached[0]>time_now:
+            _cache.move_to_end(job_id)
+            return dict(cached[1])
+    with get_psql_engine().connect() as psql_connection:
+        result = psql_connection.execute(select(Job).where(Job.id==job_id)).first()
+    if result is None:
+        raise ValueError(f'No Job with id: {job_id}')
+    definition = result._asdict()
+    definition['job_name'] = definition.pop('name')
+    with _cache_lock:
+        _cache[job_id] = (time_now + JOB_DEFINITION_CACHE_TTL, definition)
+        _cache.move_to_end(job_id)
+        while len(_cache)>JOB_DEFINITION_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return dict(definition)
+
+
+def resolve_job_message(json_message:dict) -> dict:
+    """Expand a compact {instance_id, job_id, overrides} message into the job definition with overrides applied.
+
+    Messages queued in the full format (they already carry function_name) are returned unchanged.
+    """
+    if 'function_name' in json_message:
+        return json_message
+    overrides = json_message.get('overrides') or {}
+    message = get_job_definition(json_message['job_id'])
+    message.update(overrides)
+    message.update(instance_id=json_message['instance_id'], job_id=json_message['job_id'], overrides=overrides)
+    return message
@@ -0,0 +1,24 @@
+# queue each job is sent to, by function_name
+#
+# symlinked into the function apps that use it (the deploy workflow copies the target), import it as `job_queues`
+
+# tcgds imports
+from tcgds.jobs import JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME
+
+# other imports
+import os
+
+
+# the data analysis worker listens on its own queue, so it never takes the worker's jobs (or the worker its jobs)
+ANALYSIS_QUEUE_NAME = os.environ.get('ANALYSIS_QUEUE_NAME', 'analysis-jobs')
+ANALYSIS_QUEUE_CONN_STR_NAME = os.environ.get('ANALYSIS_QUEUE_CONN_STR_NAME', JOBS_QUEUE_CONN_STR_NAME)
+ANALYSIS_FUNCTION_NAMES = {
+    'odds_analysis',
+}
+
+
+def job_queue(function_name:str) -> tuple[str, str]:
+    """(queue_name, conn_str_name) of the queue that jobs of `function_name` are sent to."""
+    if function_name in ANALYSIS_FUNCTION_NAMES:
+        return ANALYSIS_QUEUE_NAME, ANALYSIS_QUEUE_CONN_STR_NAME
+    return JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME
@@ -0,0 +1,41 @@
+# postgres backed delayed queue messages: the job scheduler's dispatch_pending timer sends each at its dispatch_at
+#
+# symlinked into the function apps that use it (the deploy workflow copies the target), import it as `pending_dispatch`
+
+# tcgds imports
+from tcgds.jobs import Instance, JOBS_QUEUE_NAME, JOBS_QUEUE_CONN_STR_NAME
+
+# other imports
+from datetime import datetime
+from sqlalchemy import Connection, ForeignKey, DateTime, BigInteger, Identity, insert
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+metadata = Base.metadata
+
+
+class PendingDispatch(Base):
+    __tablename__ = 'pending_dispatch'
+
+    id: Mapped[int] = mapped_column(BigInteger, Identity(), primary_key=True)
+    instance_id = mapped_column(ForeignKey(Instance.id, ondelete='CASCADE'), nullable=True)
+    queue_name: Mapped[str]
+    conn_str_name: Mapped[str] # app setting holding the queue's connection string
+    message: Mapped[str] # encoded message content
+    dispatch_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), index=True)
+    attempts: Mapped[int] = mapped_column(default=0)
+
+
+def schedule_dispatch(psql_connection:Connection, pending:list[dict]) -> None:
+    """Add messages to pending_dispatch to be sent at their dispatch_at, within the caller's transaction.
+
+    Each item needs message and dispatch_at; instance_id, queue_name and conn_str_name default to the jobs queue.
+    """
+    if not pending:
+        return
+    defaults = dict(instance_id=None, queue_name=JOBS_QUEUE_NAME, conn_str_name=JOBS_QUEUE_CONN_STR_NAME, attempts=0)
+    psql_connection.execute(insert(PendingDispatch), [defaults | item for item in pending])
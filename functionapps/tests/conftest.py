@@ -0,0 +1,33 @@
+# unit checks of the scheduler, worker and analysis hot paths, run with `python -m pytest functionapps/tests`
+#
+# the app folders are not packages and share module names (models, resources, function_app), so each test module calls
+# use_app before importing from its app: the app goes first on sys.path and modules imported from another app are dropped
+
+# other imports
+import os
+import sys
+import pytest
+from sqlalchemy import create_engine, Engine
+
+
+FUNCTIONAPPS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR_PREFIX = os.path.join(FUNCTIONAPPS_DIR, 'linux-python-')
+
+
+def use_app(app_folder:str) -> None:
+    app_dir = os.path.join(FUNCTIONAPPS_DIR, app_folder)
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, '__file__', None) or ''
+        if module_file.startswith(APP_DIR_PREFIX) and not module_file.startswith(app_dir + os.sep):
+            del sys.modules[name]
+    if app_dir in sys.path:
+        sys.path.remove(app_dir)
+    sys.path.insert(0, app_dir)
+
+
+@pytest.fixture
+def sqlite_engine() -> Engine:
+    # the postgres insert constructs used by the apps (on conflict, returning) also compile for sqlite
+    engine = create_engine('sqlite://')
+    yield engine
+    engine.dispose()
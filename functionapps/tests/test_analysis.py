@@ -0,0 +1,64 @@
+from conftest import use_app
+use_app('linux-python-data-analysis-worker')
+
+# local imports
+from analysis import implied_probability, complete_groups, line_movement, SNAPSHOT_COL
+
+# other imports
+import pytest
+import numpy as np
+import pandas as pd
+
+
+def _snapshots() -> pd.DataFrame:
+    # sorted by (betting_opportunity_id, added) as the scan returns them, groups of 1 to 4 snapshots
+    sizes = {'a':3, 'b':1, 'c':4, 'd':2}
+    rows = [(key, pd.Timestamp('2026-10-18', tz='UTC') + pd.Timedelta(minutes=i), 0.3 + 0.1*i) for key, size in sizes.items() for i in range(size)]
+    return pd.DataFrame(rows, columns=['betting_opportunity_id', SNAPSHOT_COL, 'implied_probability'])
+
+
+def _chunks(frame:pd.DataFrame, chunk_size:int) -> list[pd.DataFrame]:
+    return [frame.iloc[i:i+chunk_size].reset_index(drop=True) for i in range(0, len(frame), chunk_size)]
+
+
+def test_implied_probability():
+    decimal_odds = pd.Series([2.0, None, 1.0])
+    american_odds = pd.Series([None, -300, 150])
+    np.testing.assert_allclose(implied_probability(decimal_odds, american_odds), [0.5, 0.75, 0.4])
+    assert np.isnan(implied_probability(american_odds=pd.Series([50]))).all()
+    with pytest.raises(ValueError):
+        implied_probability()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 4, 5, 10, 100])
+def test_complete_groups_never_splits_a_group(chunk_size):
+    snapshots = _snapshots()
+    frames = list(complete_groups(iter(_chunks(snapshots, chunk_size)), ['betting_opportunity_id']))
+    keys = [set(frame['betting_opportunity_id']) for frame in frames]
+    # every key lands in exactly one frame and no row is lost or repeated
+    assert sum(len(frame_keys) for frame_keys in keys)==len(set().union(*keys))==4
+    pd.testing.assert_frame_equal(pd.concat(frames, ignore_index=True), snapshots)
+
+
+def test_complete_groups_skips_empty_frames():
+    snapshots = _snapshots()
+    # the empty frames yield nothing, c and d are each held back until the next chunk
+    frames = [snapshots.iloc[:0], snapshots.iloc[:5], snapshots.iloc[:0], snapshots.iloc[5:].reset_index(drop=True)]
+    assert [len(frame) for frame in complete_groups(iter(frames), ['betting_opportunity_id'])]==[4, 4, 2]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7])
+def test_line_movement_across_chunk_edges(chunk_size):
+    snapshots = _snapshots()
+    chunked = pd.concat([line_movement(frame) for frame in complete_groups(iter(_chunks(snapshots, chunk_size)), ['betting_opportunity_id'])], ignore_index=True)
+    pd.testing.assert_frame_equal(chunked, line_movement(snapshots))
+
+
+def test_line_movement():
+    movement = line_movement(_snapshots()).set_index('betting_opportunity_id')
+    assert movement['snapshots'].to_dict()=={'a':3, 'b':1, 'c':4, 'd':2}
+    np.testing.assert_allclose(movement.loc['c', ['opening_probability', 'closing_probability', 'min_probability', 'max_probability', 'movement']].to_numpy(dtype=float),
+                               [0.3, 0.6, 0.3, 0.6, 0.3])
+    assert movement.loc['b', 'movement']==0
+    assert movement.loc['c', 'first_added']==pd.Timestamp('2026-10-18', tz='UTC')
+    assert movement.loc['c', 'last_added']==pd.Timestamp('2026-10-18 00:03', tz='UTC')
@@ -0,0 +1,75 @@
+from conftest import use_app
+use_app('linux-python-worker')
+
+# tcgds imports
+from tcgds.jobs import Instance
+
+# local imports
+from models import Base, JobLease, InstanceShard
+from leases import lease_slots, acquire_lease, LEASE_ACQUIRED, LEASE_BUSY, LEASE_RUNNING, LEASE_COMPLETED, LEASE_TTL_SECONDS
+
+# other imports
+import pytest
+from datetime import datetime, timedelta, UTC
+from sqlalchemy import insert, update
+
+
+@pytest.fixture
+def psql_connection(sqlite_engine):
+    Instance.metadata.create_all(sqlite_engine)
+    Base.metadata.create_all(sqlite_engine)
+    with sqlite_engine.begin() as psql_connection:
+        psql_connection.execute(insert(Instance), [
+            dict(id='i1', job_id='j', status='queued'),
+            dict(id='i2', job_id='j', status='queued'),
+            dict(id='done', job_id='j', status='completed'),
+        ])
+    with sqlite_engine.connect() as psql_connection:
+        yield psql_connection
+
+
+def test_lease_slots():
+    assert lease_slots('update', 'i1', None, 2)==('update', range(2))
+    assert lease_slots('update', 'i1', None, 0)==('update', range(0))
+    # a shard leases the one slot of its index under its instance's name
+    assert lease_slots('update', 'i1', 3, 2)==('update/i1', range(3, 4))
+
+
+def test_acquire_lease_outcomes(psql_connection):
+    assert acquire_lease(psql_connection, 'update', range(1), 'i1', None)==(LEASE_ACQUIRED, 0)
+    # the only slot is held by i1
+    assert acquire_lease(psql_connection, 'update', range(1), 'i2', None)==(LEASE_BUSY, None)
+    # a redelivered message of i1 while its lease is alive
+    assert acquire_lease(psql_connection, 'update', range(1), 'i1', None)==(LEASE_RUNNING, None)
+    assert acquire_lease(psql_connection, 'update', range(1), 'done', None)==(LEASE_COMPLETED, None)
+    # an unlimited job type holds no slot
+    assert acquire_lease(psql_connection, 'other', range(0), 'i2', None)==(LEASE_ACQUIRED, None)
+
+
+def test_acquire_lease_takes_over_an_expired_slot(psql_connection):
+    assert acquire_lease(psql_connection, 'update', range(1), 'i1', None)==(LEASE_ACQUIRED, 0)
+    expired = datetime.now(tz=UTC) - timedelta(seconds=LEASE_TTL_SECONDS + 1)
+    psql_connection.execute(update(JobLease).values(heartbeat_at=expired))
+    psql_connection.commit()
+    assert acquire_lease(psql_connection, 'update', range(1), 'i2', None)==(LEASE_ACQUIRED, 0)
+
+
+def test_acquire_lease_keeps_the_slot_of_queued_shards(psql_connection):
+    # i1 fanned out and its shards wait on the queue, its type slot is not taken over once its heartbeat is stale
+    assert acquire_lease(psql_connection, 'update', range(1), 'i1', None)==(LEASE_ACQUIRED, 0)
+    psql_connection.execute(insert(InstanceShard), [dict(instance_id='i1', shard_index=0, items=[], status='queued')])
+    psql_connection.execute(update(JobLease).values(heartbeat_at=datetime.now(tz=UTC) - timedelta(seconds=LEASE_TTL_SECONDS + 1)))
+    psql_connection.commit()
+    assert acquire_lease(psql_connection, 'update', range(1), 'i2', None)==(LEASE_BUSY, None)
+
+
+def test_acquire_lease_shards(psql_connection):
+    psql_connection.execute(insert(InstanceShard), [dict(instance_id='i1', shard_index=i, items=[], status='queued') for i in range(2)])
+    psql_connection.commit()
+    # shards of one instance run in parallel, each only once at a time, and a completed shard is not rerun
+    assert acquire_lease(psql_connection, 'update/i1', range(0, 1), 'i1', 0)==(LEASE_ACQUIRED, 0)
+    assert acquire_lease(psql_connection, 'update/i1', range(1, 2), 'i1', 1)==(LEASE_ACQUIRED, 1)
+    assert acquire_lease(psql_connection, 'update/i1', range(0, 1), 'i1', 0)==(LEASE_RUNNING, None)
+    psql_connection.execute(update(InstanceShard).where(InstanceShard.shard_index==1).values(status='completed'))
+    psql_connection.commit()
+    assert acquire_lease(psql_connection, 'update/i1', range(1, 2), 'i1', 1)==(LEASE_COMPLETED, None)
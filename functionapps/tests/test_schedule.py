@@ -0,0 +1,69 @@
+from conftest import use_app
+use_app('linux-python-job-scheduler')
+
+# tcgds imports
+from tcgds.jobs import Job
+
+# local imports
+from models import Base
+from schedule import next_start_time, claim_runs, SCHEDULE_GRACE_SECONDS, SCHEDULE_CATCH_UP_HOURS
+
+# other imports
+import pytest
+from datetime import datetime, timedelta, UTC
+from sqlalchemy import insert
+
+
+HOURLY = '0 * * * *'
+TIME_NOW = datetime(2026, 10, 18, 11, 0, 30, tzinfo=UTC) # timer start, 30s after the 11:00 slot
+
+
+def test_next_start_time_keeps_a_future_slot():
+    next_run_at = datetime(2026, 10, 18, 12, 0, tzinfo=UTC)
+    assert next_start_time(HOURLY, next_run_at, TIME_NOW)==next_run_at
+
+
+@pytest.mark.parametrize('seconds_late, expected', [
+    (SCHEDULE_GRACE_SECONDS, datetime(2026, 10, 18, 11, 0, tzinfo=UTC)), # the missed slot is exactly at the grace edge
+    (SCHEDULE_GRACE_SECONDS + 1, datetime(2026, 10, 18, 12, 0, tzinfo=UTC)),
+])
+def test_next_start_time_grace_boundary(seconds_late, expected):
+    time_now = datetime(2026, 10, 18, 11, 0, tzinfo=UTC) + timedelta(seconds=seconds_late)
+    next_run_at = datetime(2026, 10, 18, 11, 0, tzinfo=UTC)
+    assert next_start_time(HOURLY, next_run_at, time_now)==expected
+
+
+@pytest.mark.parametrize('hours_late, expected', [
+    (SCHEDULE_CATCH_UP_HOURS, datetime(2026, 10, 18, 11, 0, tzinfo=UTC)), # the missed slot is exactly at the catch up edge
+    (SCHEDULE_CATCH_UP_HOURS + 1, datetime(2026, 10, 19, 11, 0, tzinfo=UTC)),
+])
+def test_next_start_time_catch_up_boundary(hours_late, expected):
+    daily = '0 11 * * *'
+    time_now = datetime(2026, 10, 18, 11, 0, tzinfo=UTC) + timedelta(hours=hours_late)
+    next_run_at = datetime(2026, 10, 18, 11, 0, tzinfo=UTC)
+    assert next_start_time(daily, next_run_at, time_now, past_due=True)==expected
+    # without past_due only the grace period applies
+    assert next_start_time(daily, next_run_at, time_now)==datetime(2026, 10, 19, 11, 0, tzinfo=UTC)
+
+
+def test_next_start_time_skips_slots_before_next_run_at():
+    # a job reactivated after its last scheduled slot does not run the slots it missed while inactive
+    next_run_at = datetime(2026, 10, 18, 11, 0, 10, tzinfo=UTC)
+    assert next_start_time(HOURLY, next_run_at, TIME_NOW)==datetime(2026, 10, 18, 12, 0, tzinfo=UTC)
+
+
+def test_claim_runs_conflicts(sqlite_engine):
+    Job.metadata.create_all(sqlite_engine)
+    Base.metadata.create_all(sqlite_engine)
+    start_time = datetime(2026, 10, 18, 11, 0, tzinfo=UTC)
+    with sqlite_engine.begin() as psql_connection:
+        psql_connection.execute(insert(Job), [dict(id=job_id, name=job_id, function_name='noop', cron_schedule=HOURLY, status='active') for job_id in ('a', 'b')])
+        assert claim_runs(psql_connection, [])==set()
+        assert claim_runs(psql_connection, [dict(job_id='a', start_time=start_time, instance_id='i1')])=={'i1'}
+        # the same (job_id, start_time) again is a no-op, another slot or job is claimed
+        runs = [
+            dict(job_id='a', start_time=start_time, instance_id='i2'),
+            dict(job_id='a', start_time=start_time + timedelta(hours=1), instance_id='i3'),
+            dict(job_id='b', start_time=start_time, instance_id='i4'),
+        ]
+        assert claim_runs(psql_connection, runs)=={'i3', 'i4'}